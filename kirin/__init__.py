@@ -72,6 +72,21 @@ else:  # Default is std out
     app.logger.setLevel('INFO')
 
 rabbitmq_handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'],
-                                   app.config['EXCHANGE'])
+                                   app.config['EXCHANGE'],
+                                   app.config.get('PUBLISHER_CONFIRMS', False),
+                                   app.config.get('PUBLISHER_MAX_IN_FLIGHT', 100),
+                                   app.config.get('PUBLISHER_CONFIRM_TIMEOUT', 5))
+
+from kirin.navitia_cache import make_navitia_cache
+navitia_vj_cache = make_navitia_cache(app.config)
+
+from kirin.core.coalescing import CoalescingPublisher
+feed_coalescer = CoalescingPublisher(app.config.get('PUBLICATION_COALESCING_WINDOW'),
+                                     app.config.get('PUBLICATION_COALESCING_MAX_SIZE', 1000))
+
+from kirin.core.priority import PriorityPublisher
+priority_publisher = PriorityPublisher(app.config.get('PRIORITY_PUBLICATION_LANE_SIZE', 1000),
+                                       app.config.get('PRIORITY_PUBLICATION_BATCH_SIZE', 100),
+                                       app.config.get('PRIORITY_PUBLICATION_TIMEOUT', 5))
 
 import kirin.api
@@ -58,6 +58,10 @@ api.add_resource(gtfs_rt.GtfsRT,
                  '/gtfs_rt',
                  endpoint='gtfs_rt')
 
+api.add_resource(resources.RealTimeUpdateStatus,
+                 '/real_time_updates/<string:id>',
+                 endpoint='real_time_update')
+
 
 def log_exception(sender, exception):
     """
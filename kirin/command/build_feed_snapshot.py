@@ -0,0 +1,52 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from kirin import manager, db
+from kirin.core.model import TripUpdate, FeedEntitySnapshot
+from kirin.core.populate_pb import encode_entity
+import logging
+
+
+@manager.command
+def build_feed_snapshot(batch_size=1000):
+    """
+    build the snapshot of the encoded gtfs-rt entities of the trip updates not yet in it
+
+    to be run once GTFSRT_SNAPSHOT is activated: the entities written meanwhile by the handling of the updates
+    are more recent, so they are not overwritten
+    """
+    logger = logging.getLogger(__name__)
+    batch_size = int(batch_size)
+    contributors = [c for (c,) in db.session.query(TripUpdate.contributor).distinct()]
+    nb_done = 0
+    for trip_updates in TripUpdate.find_by_contributor_period_by_chunks(contributors, chunk_size=batch_size):
+        FeedEntitySnapshot.upsert(trip_updates, encode_entity, overwrite=False)
+        nb_done += len(trip_updates)
+        logger.info('%s trip updates done', nb_done)
+    db.session.commit()
@@ -0,0 +1,55 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from kirin import manager, db
+from kirin.core.model import RealTimeUpdate
+import logging
+
+
+@manager.command
+def compress_raw_data(batch_size=1000):
+    """
+    move the raw data of the old RealTimeUpdates from the text column to the binary one
+    (encoded with the RAW_DATA_CODEC)
+
+    it is done by batches, so it can be run while kirin is running
+    """
+    logger = logging.getLogger(__name__)
+    batch_size = int(batch_size)
+    nb_done = 0
+    while True:
+        rt_updates = RealTimeUpdate.find_with_text_raw_data(batch_size)
+        if not rt_updates:
+            break
+        for rt_update in rt_updates:
+            # the setter stores it in the binary column
+            rt_update.raw_data = rt_update.raw_data
+        db.session.commit()
+        nb_done += len(rt_updates)
+        logger.info('%s real time updates converted', nb_done)
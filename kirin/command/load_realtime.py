@@ -35,4 +35,7 @@ def load_realtime():
     """
     Launch the server that serve realtime updates to starting kraken
     """
-    kirin.rabbitmq_handler.listen_load_realtime(kirin.app.config['LOAD_REALTIME_QUEUE'], kirin.app.config['RETRY_TIMEOUT'])
+    kirin.rabbitmq_handler.listen_load_realtime(kirin.app.config['LOAD_REALTIME_QUEUE'],
+                                                kirin.app.config['RETRY_TIMEOUT'],
+                                                kirin.app.config.get('LOAD_REALTIME_CHUNK_SIZE'),
+                                                kirin.app.config.get('GTFSRT_SNAPSHOT'))
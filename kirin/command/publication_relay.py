@@ -0,0 +1,70 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from kirin import manager, db, app
+from kirin.core.handler import publish_outbox
+from kirin.exceptions import MessageNotPublished
+import logging
+import time
+
+
+@manager.command
+def publication_relay():
+    """
+    publish the feeds written in the outbox (see PUBLICATION_OUTBOX) to rabbitmq
+
+    the messages are published in order, by batches. When rabbitmq is unavailable the relay
+    waits longer and longer (up to OUTBOX_RELAY_MAX_BACKOFF) before retrying
+    """
+    logger = logging.getLogger(__name__)
+    batch_size = app.config['OUTBOX_RELAY_BATCH_SIZE']
+    poll_interval = app.config['OUTBOX_RELAY_POLL_INTERVAL']
+    max_backoff = app.config['OUTBOX_RELAY_MAX_BACKOFF']
+    backoff = 0
+    while True:
+        nb_published = 0
+        try:
+            nb_published = publish_outbox(batch_size)
+            backoff = 0
+        except MessageNotPublished:
+            backoff = min(max(1, backoff * 2), max_backoff)
+            logger.warning('impossible to publish the outbox, retrying in %s sec', backoff)
+        except Exception:
+            backoff = min(max(1, backoff * 2), max_backoff)
+            logger.exception('error in the publication relay, retrying in %s sec', backoff)
+        finally:
+            db.session.remove()
+
+        if nb_published:
+            logger.debug('%s messages published', nb_published)
+        if backoff:
+            time.sleep(backoff)
+        elif nb_published < batch_size:
+            # the outbox is empty
+            time.sleep(poll_interval)
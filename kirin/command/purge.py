@@ -27,20 +27,41 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
-from kirin import manager, db
-from kirin.core.model import VehicleJourney
+from kirin import manager, app
+from kirin.core.model import VehicleJourney, RealTimeUpdate
+import json
 import datetime
 import logging
+from flask_restful.inputs import boolean
 
 @manager.command
-def purge(nb_day_to_keep):
+def purge(nb_day_to_keep, batch_size=1000):
     """
     purge the database from old information
 
+    it is done by batches, so it can be run while kirin is running
     """
     logger = logging.getLogger(__name__)
     until = datetime.date.today() - datetime.timedelta(days=int(nb_day_to_keep))
     logger.info('purge until %s', until)
-    VehicleJourney.purge(until)
-    db.session.commit()
+    nb_deleted = VehicleJourney.purge(until, int(batch_size))
+    logger.info('purge finished, %s vehicle journeys deleted', nb_deleted)
 
+
+@manager.command
+def purge_rt_update(retention=None, keep_metadata=None, batch_size=None):
+    """
+    purge the real_time_updates older than their retention, independently of their trips
+
+    by default the retention, keep_metadata and batch_size are RT_UPDATE_RETENTION,
+    RT_UPDATE_RETENTION_KEEP_METADATA and RT_UPDATE_RETENTION_BATCH_SIZE,
+    the retention can be given as json like '{"ire": {"KO": 30, "*": 7}}'
+    """
+    logger = logging.getLogger(__name__)
+    retention = json.loads(retention) if retention else app.config['RT_UPDATE_RETENTION']
+    keep_metadata = boolean(keep_metadata) if keep_metadata is not None \
+        else app.config['RT_UPDATE_RETENTION_KEEP_METADATA']
+    batch_size = int(batch_size or app.config['RT_UPDATE_RETENTION_BATCH_SIZE'])
+    logger.info('purge of the real time updates with the retention %s', retention)
+    nb_purged = RealTimeUpdate.apply_retention(retention, keep_metadata, batch_size)
+    logger.info('purge finished, %s real time updates purged', nb_purged)
@@ -0,0 +1,96 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from collections import OrderedDict
+import gevent
+import gevent.lock
+from kirin.core.populate_pb import encode_entity
+from kirin.core.publisher import DeferredPublisher
+
+
+class CoalescingPublisher(DeferredPublisher):
+    """
+    buffer the trip updates to publish by contributor, and publish them in one feed per window
+
+    during the window, only the latest state of each trip is kept, so a trip updated several times
+    is published once. A feed is published at the end of the window, or before if max_size trips are buffered.
+    The buffer is in memory: it is only shared by the greenlets of a process
+    """
+    def __init__(self, window, max_size=1000, publish=None):
+        super(CoalescingPublisher, self).__init__(publish)
+        self.window = window
+        self.max_size = max_size
+        self._buffers = {}  # contributor -> OrderedDict(trip key -> encoded entity)
+        self._timers = {}  # contributor -> greenlet flushing the buffer at the end of the window
+        self._locks = {}  # contributor -> lock to publish the feeds of a contributor in order
+        self.stats = {'published_feeds': 0, 'published_trips': 0, 'coalesced_trips': 0, 'errors': 0}
+
+    def add(self, contributor, trip_updates):
+        """
+        buffer the trip updates (they are encoded right away, while they are attached to the session)
+        """
+        self.add_entities(contributor, [(trip_update.vj_id, encode_entity(trip_update))
+                                        for trip_update in trip_updates])
+
+    def add_entities(self, contributor, entities):
+        buffer = self._buffers.get(contributor)
+        if buffer is None:
+            buffer = self._buffers[contributor] = OrderedDict()
+            self._timers[contributor] = gevent.spawn_later(self.window, self.flush, contributor)
+        for key, data in entities:
+            if buffer.pop(key, None) is not None:
+                self.stats['coalesced_trips'] += 1
+            buffer[key] = data
+        if len(buffer) >= self.max_size:
+            gevent.spawn(self.flush, contributor)
+
+    def flush(self, contributor):
+        """
+        publish the trips buffered for the contributor in one DIFFERENTIAL feed
+        """
+        buffer = self._buffers.pop(contributor, None)
+        timer = self._timers.pop(contributor, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            # the buffer is flushed before the end of its window, the timer must not flush the next one
+            timer.kill(block=False)
+        if not buffer:
+            return
+        lock = self._locks.setdefault(contributor, gevent.lock.Semaphore())
+        with lock:
+            if self._publish_entities(buffer.values(), contributor):
+                self.stats['published_feeds'] += 1
+                self.stats['published_trips'] += len(buffer)
+            else:
+                self.stats['errors'] += 1
+
+    def info(self):
+        res = {'window': self.window,
+               'buffered_trips': {contributor: len(b) for contributor, b in self._buffers.items()}}
+        res.update(self.stats)
+        return res
@@ -0,0 +1,70 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+"""
+codecs used to store the raw data received by kirin
+
+the codec name is stored along with the data, so the data can always be decoded whatever the configuration
+"""
+import zlib
+
+# wbits for a gzip container in zlib
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _zstd():
+    # zstandard is only needed for the 'zstd' codec
+    import zstandard
+    return zstandard
+
+
+def encode(data, codec):
+    """
+    >>> encode('bob', 'raw')
+    'bob'
+    >>> decode(encode('bob' * 100, 'gzip'), 'gzip') == 'bob' * 100
+    True
+    """
+    if codec == 'raw':
+        return data
+    if codec == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor().compress(data)
+    raise ValueError('unknown codec {}'.format(codec))
+
+
+def decode(data, codec):
+    if codec == 'raw':
+        return data
+    if codec == 'gzip':
+        return zlib.decompress(data, GZIP_WBITS)
+    if codec == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(data)
+    raise ValueError('unknown codec {}'.format(codec))
@@ -27,27 +27,76 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 import logging
+from collections import defaultdict
 from datetime import timedelta
 import socket
 import pytz
+from flask.globals import current_app
+from sqlalchemy.orm.attributes import set_committed_value
 import kirin
 from kirin import gtfs_realtime_pb2
 
 from kirin.core import model
-from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate
+from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate, FeedEntitySnapshot, OutboxMessage
 import datetime
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.populate_pb import serialize_gtfsrt, encode_entity
 from kirin.exceptions import MessageNotPublished
+from kirin.navitia_cache import get_or_build
+from kirin.rabbitmq_handler import PublishNotConfirmed
 
 
-def persist(real_time_update):
+def persist(real_time_update, outbox_contributor=None):
     """
     receive a RealTimeUpdate and persist it in the database
+
+    with SINGLE_TRANSACTION_INGESTION, the RealTimeUpdate itself is written in this commit too
+    if outbox_contributor is given, the feed of the TripUpdates is written in the outbox for this contributor
     """
-    model.db.session.add(real_time_update)
+    if current_app.config.get('BULK_PERSISTENCE'):
+        _bulk_persist(real_time_update)
+    else:
+        model.db.session.add(real_time_update)
+    if current_app.config.get('GTFSRT_SNAPSHOT'):
+        # the snapshot is updated in the same transaction, so it is always consistent with the TripUpdates
+        model.db.session.flush()
+        FeedEntitySnapshot.upsert(real_time_update.trip_updates, encode_entity)
+    if outbox_contributor and real_time_update.trip_updates:
+        # the feed will be published by the relay once committed, so it cannot be lost
+        model.db.session.flush()
+        model.db.session.add(OutboxMessage(outbox_contributor, serialize_gtfsrt(real_time_update.trip_updates)))
+    if real_time_update.connector in current_app.config.get('ASYNCHRONOUS_COMMIT_CONNECTORS', []):
+        # the commit does not wait for the data to be on disk, a crash of postgres can lose the last updates
+        model.db.session.execute('SET LOCAL synchronous_commit TO OFF')
     model.db.session.commit()
 
 
+def _bulk_persist(real_time_update):
+    """
+    persist the RealTimeUpdate, but the StopTimeUpdates (the biggest part of the rows)
+    are written in bulk instead of one by one by the unit of work of sqlalchemy
+
+    the commit is left to the caller, after it the objects are reloaded from the db as usual
+    """
+    session = model.db.session
+    session.add(real_time_update)
+    stop_time_updates = []
+    with session.no_autoflush:
+        for trip_update in real_time_update.trip_updates:
+            stus = list(trip_update.stop_time_updates)
+            for stu in stus:
+                stu.trip_update_id = trip_update.vj.id
+                if stu in session:
+                    session.expunge(stu)
+            # the collection is marked as already persisted, so the unit of work will not write the
+            # StopTimeUpdates. Those removed from the collection are still deleted as orphans
+            set_committed_value(trip_update, 'stop_time_updates', stus)
+            stop_time_updates.extend(stus)
+
+    # the TripUpdates need to be there before the StopTimeUpdates
+    session.flush()
+    StopTimeUpdate.bulk_upsert(stop_time_updates, current_app.config.get('BULK_PERSISTENCE_BATCH_SIZE', 1000))
+
+
 def log_stu_modif(trip_update, stu, string_additional_info):
     logger = logging.getLogger(__name__)
     logger.info("TripUpdate {vj_id} on {date}, StopTimeUpdate {order} modified: {add_info}".format(
@@ -118,27 +167,74 @@ def handle(real_time_update, trip_updates, contributor):
     if not real_time_update:
         raise TypeError()
 
+    skip_unchanged = current_app.config.get('PUBLISH_ONLY_CHANGED_TRIP_UPDATES')
+    nb_unchanged = 0
+
+    dated_vjs = [_dated_vj_key(tu) for tu in trip_updates]
+    if current_app.config.get('TRIP_UPDATE_ADVISORY_LOCKS'):
+        # the handlings of the same trips by concurrent workers are serialized until the commit of persist
+        TripUpdate.lock_dated_vjs(dated_vjs)
+
+    # find all the rows already in db in one query
+    db_trip_updates = TripUpdate.find_by_dated_vjs(dated_vjs)
+
     for trip_update in trip_updates:
-        # find if there already a row in db
-        old = TripUpdate.find_by_dated_vj(trip_update.vj.navitia_trip_id, trip_update.vj.circulation_date)
+        key = _dated_vj_key(trip_update)
+        old = db_trip_updates.get(key)
+        old_fingerprint = old.fingerprint if old else None
         # merge the theoric, the current realtime, and the new realtime
         current_trip_update = merge(trip_update.vj.navitia_vj, old, trip_update)
 
         # manage and adjust consistency if possible
-        if manage_consistency(current_trip_update):
+        consistent = manage_consistency(current_trip_update)
+        # even a rejected trip update may have been changed by the merge and be written with the others,
+        # its fingerprint is kept up to date as the encoded entities are cached by fingerprint
+        current_trip_update.fingerprint = current_trip_update.compute_fingerprint()
+        if consistent:
+            if skip_unchanged and old_fingerprint == current_trip_update.fingerprint:
+                # nothing new for this trip, there is no need to save it or to send it to navitia
+                nb_unchanged += 1
+                continue
             # we have to link the current_vj_update with the new real_time_update
             # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
             current_trip_update.real_time_updates.append(real_time_update)
+            # if the same vj is updated again later in the same message, we merge with this one
+            db_trip_updates[key] = current_trip_update
 
-    persist(real_time_update)
+    use_outbox = current_app.config.get('PUBLICATION_OUTBOX')
+    persist(real_time_update, outbox_contributor=contributor if use_outbox else None)
 
-    feed = convert_to_gtfsrt(real_time_update.trip_updates)
+    if nb_unchanged:
+        logging.getLogger(__name__).info('{} unchanged trip updates not published'.format(nb_unchanged))
+        if not real_time_update.trip_updates:
+            return real_time_update
+
+    if use_outbox:
+        # the relay publishes it
+        return real_time_update
+
+    if current_app.config.get('PUBLICATION_COALESCING_WINDOW'):
+        # published with the other updates of the contributor at the end of the window
+        kirin.feed_coalescer.add(contributor, real_time_update.trip_updates)
+        return real_time_update
+
+    if current_app.config.get('PRIORITY_PUBLICATION'):
+        # published by the lane of its class, the cancellations and the big changes first
+        delay_threshold = timedelta(seconds=current_app.config.get('PRIORITY_PUBLICATION_DELAY_THRESHOLD', 600))
+        kirin.priority_publisher.add(contributor, real_time_update.trip_updates, delay_threshold)
+        return real_time_update
+
+    feed = serialize_gtfsrt(real_time_update.trip_updates)
 
     publish(feed, contributor)
 
     return real_time_update
 
 
+def _dated_vj_key(trip_update):
+    return trip_update.vj.navitia_trip_id, trip_update.vj.circulation_date
+
+
 def _get_timezone(stop_time):
     str_tz = stop_time.get('stop_point', {}).get('stop_area', {}).get('timezone')
     if not str_tz:
@@ -158,6 +254,43 @@ def _get_datetime(circulation_date, time, timezone):
     return dt.replace(tzinfo=None)
 
 
+def _compute_base_schedule(navitia_vj, circulation_date):
+    base_schedule = []
+    last_nav_dep = None
+    for navitia_stop in navitia_vj.get('stop_times', []):
+        # TODO handle forbidden pickup/dropoff (in those case set departure/arrival at None)
+        nav_departure_time = navitia_stop.get('departure_time')
+        nav_arrival_time = navitia_stop.get('arrival_time')
+        timezone = _get_timezone(navitia_stop)
+
+        arrival = departure = None
+        if nav_arrival_time:
+            if last_nav_dep and last_nav_dep > nav_arrival_time:
+                # last departure is after arrival, it's a past-midnight
+                circulation_date += timedelta(days=1)
+            arrival = _get_datetime(circulation_date, nav_arrival_time, timezone)
+        if nav_departure_time:
+            if nav_arrival_time and nav_arrival_time > nav_departure_time:
+                # departure is before arrival, it's a past-midnight
+                circulation_date += timedelta(days=1)
+            departure = _get_datetime(circulation_date, nav_departure_time, timezone)
+
+        base_schedule.append((arrival, departure))
+        last_nav_dep = nav_departure_time
+    return base_schedule
+
+
+def get_base_schedule(navitia_vj, circulation_date):
+    """
+    return the UTC (arrival, departure) of each stop_time of the navitia vj on the circulation date
+
+    the past-midnight are handled, and the result is computed only once per (vj, circulation_date)
+    as long as the navitia vj is cached
+    """
+    return get_or_build(navitia_vj, 'base_schedule_{}'.format(circulation_date.isoformat()),
+                        lambda vj: _compute_base_schedule(vj, circulation_date))
+
+
 def merge(navitia_vj, db_trip_update, new_trip_update):
     """
     We need to merge the info from 3 sources:
@@ -201,29 +334,23 @@ def merge(navitia_vj, db_trip_update, new_trip_update):
         res.stop_time_updates = []
         return res
 
-    last_nav_dep = None
-    circulation_date = new_trip_update.vj.circulation_date
-    for navitia_stop in navitia_vj.get('stop_times', []):
+    base_schedule = get_base_schedule(navitia_vj, new_trip_update.vj.circulation_date)
+    # number of times each stop has already been served by the vj (for lollipop lines for example)
+    nb_stop_occurrences = defaultdict(int)
+    # when the model maker has found the stop_times of the new StopTimeUpdates, they are matched by position,
+    # else by occurrence of their stop
+    new_st_by_position = {st.vj_position: st for st in new_trip_update.stop_time_updates
+                          if st.vj_position is not None}
+    for position, (navitia_stop, (arrival, departure)) in enumerate(zip(navitia_vj.get('stop_times', []),
+                                                                        base_schedule)):
         stop_id = navitia_stop.get('stop_point', {}).get('id')
-        new_st = new_trip_update.find_stop(stop_id)
-        db_st = db_trip_update.find_stop(stop_id) if db_trip_update else None
-
-        # TODO handle forbidden pickup/dropoff (in those case set departure/arrival at None)
-        nav_departure_time = navitia_stop.get('departure_time')
-        nav_arrival_time = navitia_stop.get('arrival_time')
-        timezone = _get_timezone(navitia_stop)
-
-        arrival = departure = None
-        if nav_arrival_time:
-            if last_nav_dep and last_nav_dep > nav_arrival_time:
-                # last departure is after arrival, it's a past-midnight
-                circulation_date += timedelta(days=1)
-            arrival = _get_datetime(circulation_date, nav_arrival_time, timezone)
-        if nav_departure_time:
-            if nav_arrival_time and nav_arrival_time > nav_departure_time:
-                # departure is before arrival, it's a past-midnight
-                circulation_date += timedelta(days=1)
-            departure = _get_datetime(circulation_date, nav_departure_time, timezone)
+        occurrence = nb_stop_occurrences[stop_id]
+        nb_stop_occurrences[stop_id] += 1
+        if new_st_by_position:
+            new_st = new_st_by_position.get(position)
+        else:
+            new_st = new_trip_update.find_stop(stop_id, occurrence)
+        db_st = db_trip_update.find_stop(stop_id, occurrence) if db_trip_update else None
 
         if new_st:
             res_st = db_st or StopTimeUpdate(navitia_stop['stop_point'])
@@ -272,19 +399,35 @@ def merge(navitia_vj, db_trip_update, new_trip_update):
             new_st.order = len(res_stoptime_updates)
             res_stoptime_updates.append(new_st)
 
-        last_nav_dep = nav_departure_time
-
     res.stop_time_updates = res_stoptime_updates
 
     return res
 
 
+def publish_outbox(batch_size=100):
+    """
+    publish the oldest messages of the outbox, in order, and delete those published
+
+    stop at the first message that cannot be published (MessageNotPublished is raised)
+    return the number of messages published
+    """
+    published = []
+    try:
+        for message in OutboxMessage.find_oldest(batch_size):
+            publish(message.data, message.contributor)
+            published.append(message.id)
+    finally:
+        OutboxMessage.delete_by_ids(published)
+        model.db.session.commit()
+    return len(published)
+
+
 def publish(feed, contributor):
     """
-    send RT feed to navitia
+    send RT feed (already serialized) to navitia
     """
     try:
-        kirin.rabbitmq_handler.publish(feed.SerializeToString(), contributor)
-    except socket.error:
+        kirin.rabbitmq_handler.publish(feed, contributor)
+    except (socket.error, PublishNotConfirmed):
         logging.getLogger(__name__).exception('impossible to publish in rabbitmq')
         raise MessageNotPublished()
@@ -31,7 +31,11 @@ from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.orderinglist import ordering_list
 from flask_sqlalchemy import SQLAlchemy
+from flask import current_app, has_app_context
+from kirin.core import codec
 import datetime
+import hashlib
+import logging
 import sqlalchemy
 db = SQLAlchemy()
 
@@ -85,9 +89,43 @@ class VehicleJourney(db.Model):
         self.navitia_vj = navitia_vj  # Not persisted
 
     @classmethod
-    def purge(cls, until):
-        for vj in cls.query.filter(cls.circulation_date < until):
-            db.session.delete(vj)
+    def purge(cls, until, batch_size=1000):
+        """
+        delete the VehicleJourneys circulating before until, with their TripUpdates, StopTimeUpdates
+        and the RealTimeUpdates not linked to another TripUpdate
+
+        the rows are deleted with set-based queries (children first), by batches of batch_size VehicleJourneys
+        taken in the order of their ids, each batch being committed. Return the number of VehicleJourneys deleted
+        """
+        logger = logging.getLogger(__name__)
+        nb_deleted = 0
+        last_id = None
+        while True:
+            query = db.session.query(cls.id).filter(cls.circulation_date < until)
+            if last_id is not None:
+                query = query.filter(cls.id > last_id)
+            ids = tuple(vj_id for (vj_id,) in query.order_by(cls.id).limit(batch_size))
+            if not ids:
+                return nb_deleted
+            last_id = ids[-1]
+
+            params = {'ids': ids}
+            rt_update_ids = tuple(rtu_id for (rtu_id,) in db.session.execute(
+                'SELECT DISTINCT real_time_update_id FROM associate_realtimeupdate_tripupdate '
+                'WHERE trip_update_id IN :ids', params))
+            db.session.execute('DELETE FROM associate_realtimeupdate_tripupdate WHERE trip_update_id IN :ids', params)
+            db.session.execute('DELETE FROM stop_time_update WHERE trip_update_id IN :ids', params)
+            # the feed_entity_snapshot rows are deleted by cascade
+            db.session.execute('DELETE FROM trip_update WHERE vj_id IN :ids', params)
+            db.session.execute('DELETE FROM vehicle_journey WHERE id IN :ids', params)
+            if rt_update_ids:
+                db.session.execute('DELETE FROM real_time_update r WHERE id IN :ids AND NOT EXISTS '
+                                   '(SELECT 1 FROM associate_realtimeupdate_tripupdate a '
+                                   'WHERE a.real_time_update_id = r.id)', {'ids': rt_update_ids})
+            db.session.commit()
+
+            nb_deleted += len(ids)
+            logger.info('%s vehicle journeys purged', nb_deleted)
 
 
 class StopTimeUpdate(db.Model, TimestampMixin):
@@ -114,6 +152,9 @@ class StopTimeUpdate(db.Model, TimestampMixin):
     arrival_delay = db.Column(db.Interval, nullable=True)
     arrival_status = db.Column(ModificationType, nullable=False, default='none')
 
+    # Not persisted, position of the stop_time in the navitia vj when the model maker knows it, see merge
+    vj_position = None
+
     def __init__(self, navitia_stop,
                  departure=None, arrival=None,
                  departure_delay=None, arrival_delay=None,
@@ -130,6 +171,38 @@ class StopTimeUpdate(db.Model, TimestampMixin):
         self.arrival = arrival
         self.message = message
 
+    @classmethod
+    def bulk_upsert(cls, stop_time_updates, batch_size=1000):
+        """
+        write the StopTimeUpdates in the db with batches of 'INSERT ... ON CONFLICT DO UPDATE'
+        (postgresql >= 9.5 is needed)
+
+        this bypass the unit of work of sqlalchemy: the trip_update_id of the StopTimeUpdates must be set
+        and the objects must not be in the session
+        """
+        columns = cls.__table__.columns
+        now = datetime.datetime.utcnow()
+        rows = []
+        for stu in stop_time_updates:
+            if stu.created_at is None:
+                stu.created_at = now
+            rows.append(tuple(getattr(stu, c.key) for c in columns))
+
+        col_names = ', '.join('"{}"'.format(c.name) for c in columns)
+        updates = ', '.join('"{n}" = EXCLUDED."{n}"'.format(n=c.name) for c in columns
+                            if c.name not in ('id', 'created_at', 'updated_at'))
+        row_format = '({})'.format(', '.join(['%s'] * len(columns)))
+
+        cursor = db.session.connection().connection.cursor()
+        try:
+            for i in range(0, len(rows), batch_size):
+                values = ', '.join(cursor.mogrify(row_format, row) for row in rows[i:i + batch_size])
+                cursor.execute('INSERT INTO {table} ({cols}) VALUES {values} '
+                               'ON CONFLICT (id) DO UPDATE SET {updates}, updated_at = LOCALTIMESTAMP'
+                               .format(table=cls.__tablename__, cols=col_names, values=values, updates=updates))
+        finally:
+            cursor.close()
+
     def update_departure(self, time=None, delay=None, status=None):
         if time:
             self.departure = time
@@ -151,10 +224,26 @@ associate_realtimeupdate_tripupdate = db.Table('associate_realtimeupdate_tripupd
                                     db.metadata,
                                     db.Column('real_time_update_id', postgresql.UUID, db.ForeignKey('real_time_update.id')),
                                     db.Column('trip_update_id', postgresql.UUID, db.ForeignKey('trip_update.vj_id')),
-                                    db.PrimaryKeyConstraint('real_time_update_id', 'trip_update_id', name='associate_realtimeupdate_tripupdate_pkey')
+                                    db.PrimaryKeyConstraint('real_time_update_id', 'trip_update_id', name='associate_realtimeupdate_tripupdate_pkey'),
+                                    # the primary key cannot be used to find the rows of a trip_update
+                                    db.Index('associate_realtimeupdate_tripupdate_trip_update_id_idx', 'trip_update_id')
 )
 
 
+def _advisory_lock_key(navitia_trip_id, circulation_date):
+    """
+    postgres advisory lock key (a signed 64 bits integer) of a dated vj, stable across processes
+
+    >>> _advisory_lock_key('trip:1', datetime.date(2015, 9, 21)) == \
+    ...     _advisory_lock_key('trip:1', datetime.date(2015, 9, 21))
+    True
+    >>> -2 ** 63 <= _advisory_lock_key('trip:1', datetime.date(2015, 9, 21)) < 2 ** 63
+    True
+    """
+    digest = hashlib.sha1('{}|{}'.format(_to_utf8(navitia_trip_id), circulation_date.isoformat())).hexdigest()
+    return int(digest[:16], 16) - 2 ** 63
+
+
 class TripUpdate(db.Model, TimestampMixin):
     """
     Update information for Vehicule Journey
@@ -165,10 +254,13 @@ class TripUpdate(db.Model, TimestampMixin):
                          backref=backref('trip_update', cascade='all, delete-orphan'))
     message = db.Column(db.Text, nullable=True)
     contributor = db.Column(db.Text, nullable=True)
+    # hash of the realtime information of the TripUpdate, to detect when a new update does not change it
+    fingerprint = db.Column(db.Text, nullable=True)
     stop_time_updates = db.relationship('StopTimeUpdate', backref='trip_update', lazy='joined',
                                         order_by="StopTimeUpdate.order",
                                         collection_class=ordering_list('order'),
                                         cascade='all, delete-orphan')
+    _stop_index = None  # Not persisted, see find_stop
 
     def __init__(self, vj=None, status='none', contributor=None):
         self.created_at = datetime.datetime.utcnow()
@@ -184,6 +276,32 @@ class TripUpdate(db.Model, TimestampMixin):
         return cls.query.join(VehicleJourney).filter(VehicleJourney.navitia_trip_id == navitia_trip_id,
                                               VehicleJourney.circulation_date == vj_circulation_date).first()
 
+    @classmethod
+    def find_by_dated_vjs(cls, dated_vjs):
+        """
+        bulk version of find_by_dated_vj
+
+        take a list of (navitia_trip_id, circulation_date) and return a dict indexed by those tuples
+        with all the corresponding TripUpdates found in the db (in one query)
+        """
+        dated_vjs = set(dated_vjs)
+        if not dated_vjs:
+            return {}
+        query = cls.query.join(VehicleJourney).filter(
+            sqlalchemy.tuple_(VehicleJourney.navitia_trip_id, VehicleJourney.circulation_date).in_(dated_vjs))
+        return {(tu.vj.navitia_trip_id, tu.vj.circulation_date): tu for tu in query.all()}
+
+    @classmethod
+    def lock_dated_vjs(cls, dated_vjs):
+        """
+        take a postgres advisory lock on each (navitia_trip_id, circulation_date)
+
+        the locks are released at the end of the transaction, so the concurrent handlings of the same trips
+        are serialized. The locks are always taken in the same order to avoid deadlocks
+        """
+        for key in sorted(set(_advisory_lock_key(trip_id, date) for trip_id, date in dated_vjs)):
+            db.session.execute(sqlalchemy.text('SELECT pg_advisory_xact_lock(:key)'), {'key': key})
+
     @classmethod
     def find_by_contributor_period(cls, contributors, start_date=None, end_date=None):
         query = cls.query.filter(cls.contributor.in_(contributors))
@@ -195,19 +313,105 @@ class TripUpdate(db.Model, TimestampMixin):
                                  format(end_date=end_date))
         return query.all()
 
-    def find_stop(self, stop_id):
-        #TODO: we will need to handle vj who deserve the same stop multiple times
-        for st in self.stop_time_updates:
-            if st.stop_id == stop_id:
-                return st
-        return None
+    @classmethod
+    def _contributor_period_ids_query(cls, contributors, start_date=None, end_date=None, session=None):
+        query = (session or db.session).query(cls.vj_id).join(VehicleJourney).filter(cls.contributor.in_(contributors))
+        if start_date:
+            query = query.filter(VehicleJourney.circulation_date >= start_date)
+        if end_date:
+            query = query.filter(VehicleJourney.circulation_date <= end_date)
+        return query
+
+    @classmethod
+    def count_by_contributor_period(cls, contributors, start_date=None, end_date=None, session=None):
+        return cls._contributor_period_ids_query(contributors, start_date, end_date, session).count()
+
+    @classmethod
+    def find_by_contributor_period_by_chunks(cls, contributors, start_date=None, end_date=None,
+                                             chunk_size=1000, session=None):
+        """
+        same as find_by_contributor_period, but the TripUpdates are returned by lists of at most chunk_size elements
+
+        the ids are read with a server side cursor, and each chunk is loaded with its stop_time_updates only
+        when needed, so the memory does not depend on the number of TripUpdates.
+        The queries are done in the given session if any (db.session by default)
+        """
+        session = session or db.session
+        query = cls._contributor_period_ids_query(contributors, start_date, end_date, session)\
+            .order_by(VehicleJourney.circulation_date, cls.vj_id)
+
+        def load(ids):
+            trip_updates = {tu.vj_id: tu for tu in session.query(cls).filter(cls.vj_id.in_(ids)).all()}
+            return [trip_updates[i] for i in ids if i in trip_updates]
+
+        ids = []
+        for (vj_id,) in query.yield_per(chunk_size):
+            ids.append(vj_id)
+            if len(ids) == chunk_size:
+                yield load(ids)
+                ids = []
+        if ids:
+            yield load(ids)
+
+    def compute_fingerprint(self):
+        """
+        return a hash of all the realtime information of the TripUpdate
+        """
+        h = hashlib.sha1()
+        h.update(repr((self.status, _to_utf8(self.message), _to_utf8(self.contributor))))
+        for stu in self.stop_time_updates:
+            h.update(repr((_to_utf8(stu.stop_id), _to_utf8(stu.message),
+                           stu.departure, stu.departure_delay, stu.departure_status,
+                           stu.arrival, stu.arrival_delay, stu.arrival_status)))
+        return h.hexdigest()
+
+    def find_stop(self, stop_id, nth=0):
+        """
+        return the nth StopTimeUpdate on this stop (a vj can serve the same stop multiple times)
+
+        the StopTimeUpdates are indexed by stop_id, the index is not persisted and it is reset each time
+        the stop_time_updates list is modified
+        """
+        if self._stop_index is None:
+            self._stop_index = {}
+            for st in self.stop_time_updates:
+                self._stop_index.setdefault(st.stop_id, []).append(st)
+        stop_time_updates = self._stop_index.get(stop_id, [])
+        return stop_time_updates[nth] if nth < len(stop_time_updates) else None
+
+
+def _to_utf8(s):
+    # the strings can be either str or unicode depending on where they come from
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def _reset_stop_index(trip_update, *args):
+    trip_update._stop_index = None
+
+for event_name in ('append', 'remove', 'init_collection'):
+    sqlalchemy.event.listen(TripUpdate.stop_time_updates, event_name, _reset_stop_index)
+
+
+def _find_retention(retention, connector, status):
+    """
+    >>> retention = {"ire": {"KO": 30, "*": 7}, "*": {"KO": 20}}
+    >>> _find_retention(retention, 'ire', 'KO'), _find_retention(retention, 'ire', 'OK')
+    (30, 7)
+    >>> _find_retention(retention, 'gtfs-rt', 'KO'), _find_retention(retention, 'gtfs-rt', 'OK')
+    (20, None)
+    """
+    for c, s in ((connector, status), (connector, '*'), ('*', status), ('*', '*')):
+        days = retention.get(c, {}).get(s)
+        if days is not None:
+            return days
+    return None
 
 
 class RealTimeUpdate(db.Model, TimestampMixin):
     """
     Real Time Update received from POST request
 
-    This model is used to persist the raw_data: .
+    This model is used to persist the raw_data (the xml or the protobuf received).
     A real time update object will be constructed from the raw_xml then the
     constructed real_time_update's id should be affected to TripUpdate's real_time_update_id
 
@@ -218,7 +422,11 @@ class RealTimeUpdate(db.Model, TimestampMixin):
     connector = db.Column(db.Enum('ire', 'gtfs-rt', name='connector_type'), nullable=False)
     status = db.Column(db.Enum('OK', 'KO', 'pending', name='rt_status'), nullable=True)
     error = db.Column(db.Text, nullable=True)
-    raw_data = db.Column(db.Text, nullable=True)
+    # the raw data is stored as binary, encoded with the codec (see kirin.core.codec)
+    # the old RealTimeUpdates have their raw data in the text column, use the raw_data property to read it
+    _raw_data_text = db.Column('raw_data', db.Text, nullable=True)
+    _raw_data_bin = db.Column('raw_data_bin', db.LargeBinary, nullable=True)
+    raw_data_codec = db.Column(db.Text, nullable=True)
 
     trip_updates = db.relationship("TripUpdate", secondary=associate_realtimeupdate_tripupdate, cascade='all',
                                    lazy='select', backref=backref('real_time_updates', cascade='all'))
@@ -233,7 +441,184 @@ class RealTimeUpdate(db.Model, TimestampMixin):
         self.error = error
         self.received_at = received_at if received_at else datetime.datetime.utcnow()
 
+    @property
+    def raw_data(self):
+        """
+        the raw data received, as a str
+        """
+        if self._raw_data_bin is None:
+            return self._raw_data_text
+        return codec.decode(self._raw_data_bin, self.raw_data_codec)
+
+    @raw_data.setter
+    def raw_data(self, value):
+        self._raw_data_text = None
+        if value is None:
+            self._raw_data_bin = self.raw_data_codec = None
+            return
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.raw_data_codec = current_app.config.get('RAW_DATA_CODEC', 'gzip') if has_app_context() else 'gzip'
+        self._raw_data_bin = codec.encode(value, self.raw_data_codec)
+
+    @classmethod
+    def find_with_text_raw_data(cls, limit):
+        """
+        return the RealTimeUpdates still having their raw data in the old text column
+        """
+        return cls.query.filter(cls._raw_data_text.isnot(None)).limit(limit).all()
+
+    @classmethod
+    def purge(cls, until, connector=None, status=None, keep_metadata=False, batch_size=1000):
+        """
+        delete the RealTimeUpdates created before until (or only their raw data if keep_metadata)
+
+        they can be filtered by connector and status, the status 'OK' also matches the RealTimeUpdates
+        without status (those handled in synchronous mode).
+        It is done by batches of batch_size rows, each batch being committed. Return the number of rows purged
+        """
+        logger = logging.getLogger(__name__)
+        query = db.session.query(cls.id).filter(cls.created_at < until)
+        if connector:
+            query = query.filter(cls.connector == connector)
+        if status == 'OK':
+            query = query.filter(sqlalchemy.or_(cls.status == 'OK', cls.status.is_(None)))
+        elif status:
+            query = query.filter(cls.status == status)
+        if keep_metadata:
+            query = query.filter(sqlalchemy.or_(cls._raw_data_text.isnot(None), cls._raw_data_bin.isnot(None)))
+
+        nb_purged = 0
+        while True:
+            # the purged rows do not match the query anymore, so the next batch is always the first one
+            ids = tuple(rtu_id for (rtu_id,) in query.limit(batch_size))
+            if not ids:
+                return nb_purged
+            params = {'ids': ids}
+            if keep_metadata:
+                db.session.execute('UPDATE real_time_update SET raw_data = NULL, raw_data_bin = NULL, '
+                                   'raw_data_codec = NULL WHERE id IN :ids', params)
+            else:
+                db.session.execute('DELETE FROM associate_realtimeupdate_tripupdate '
+                                   'WHERE real_time_update_id IN :ids', params)
+                db.session.execute('DELETE FROM real_time_update WHERE id IN :ids', params)
+            db.session.commit()
+
+            nb_purged += len(ids)
+            logger.info('%s real time updates purged', nb_purged)
+
+    @classmethod
+    def apply_retention(cls, retention, keep_metadata=False, batch_size=1000):
+        """
+        purge the RealTimeUpdates older than their retention
+
+        the retention (in days) is given by connector then by status, '*' matching any connector or status,
+        like {"ire": {"KO": 30, "*": 7}, "*": {"*": 60}}. The most specific rule is applied.
+        Return the number of RealTimeUpdates purged
+        """
+        now = datetime.datetime.utcnow()
+        nb_purged = 0
+        for connector in cls.__table__.c.connector.type.enums:
+            for status in cls.__table__.c.status.type.enums:
+                days = _find_retention(retention, connector, status)
+                if days is None:
+                    continue
+                nb_purged += cls.purge(now - timedelta(days=days), connector, status, keep_metadata, batch_size)
+        return nb_purged
+
     @classmethod
     def get_last_update_by_contributor(cls):
         query = db.session.query(TripUpdate.contributor, db.func.max(cls.created_at)).join(associate_realtimeupdate_tripupdate).join(cls).group_by(TripUpdate.contributor).all()
         return {row[0]: row[1].strftime('%Y-%m-%dT%H:%M:%SZ') for row in query}
+
+
+class FeedEntitySnapshot(db.Model, TimestampMixin):
+    """
+    encoded gtfs-rt FeedEntity of each TripUpdate (see populate_pb.encode_entity)
+
+    it is the latest state of the realtime, kept up to date by the handling of the updates,
+    so a full feed can be made without loading and converting all the TripUpdates
+    """
+    __tablename__ = 'feed_entity_snapshot'
+    vj_id = db.Column(postgresql.UUID, db.ForeignKey('trip_update.vj_id', ondelete='CASCADE'), primary_key=True)
+    contributor = db.Column(db.Text, nullable=False)
+    circulation_date = db.Column(db.Date, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (db.Index('feed_entity_snapshot_contributor_circulation_date_idx',
+                               'contributor', 'circulation_date'),)
+
+    @classmethod
+    def upsert(cls, trip_updates, encode, overwrite=True):
+        """
+        write the encoded entity of the TripUpdates (already flushed)
+
+        if overwrite is False, the existing entities are kept as they are
+        """
+        if not trip_updates:
+            return
+        on_conflict = 'DO UPDATE SET contributor = EXCLUDED.contributor, data = EXCLUDED.data, ' \
+                      'updated_at = LOCALTIMESTAMP' if overwrite else 'DO NOTHING'
+        statement = sqlalchemy.text(
+            'INSERT INTO feed_entity_snapshot (vj_id, contributor, circulation_date, data, created_at) '
+            'VALUES (:vj_id, :contributor, :circulation_date, :data, LOCALTIMESTAMP) '
+            'ON CONFLICT (vj_id) {}'.format(on_conflict))\
+            .bindparams(sqlalchemy.bindparam('data', type_=db.LargeBinary))
+        db.session.execute(statement, [{'vj_id': tu.vj_id,
+                                        'contributor': tu.contributor,
+                                        'circulation_date': tu.vj.circulation_date,
+                                        'data': encode(tu)} for tu in trip_updates])
+
+    @classmethod
+    def find_data_by_contributor_period(cls, contributors, start_date=None, end_date=None):
+        """
+        same filters as TripUpdate.find_by_contributor_period, but only the encoded entities are returned
+        """
+        query = db.session.query(cls.data).filter(cls.contributor.in_(contributors))
+        if start_date:
+            query = query.filter(cls.circulation_date >= start_date)
+        if end_date:
+            query = query.filter(cls.circulation_date <= end_date)
+        return [data for (data,) in query.order_by(cls.circulation_date, cls.vj_id)]
+
+    @classmethod
+    def is_complete(cls, contributors):
+        """
+        True if every TripUpdate of the contributors has its entity in the snapshot
+
+        it is not the case as long as build_feed_snapshot has not been run
+        """
+        missing = db.session.query(TripUpdate.vj_id)\
+            .outerjoin(cls, cls.vj_id == TripUpdate.vj_id)\
+            .filter(TripUpdate.contributor.in_(contributors))\
+            .filter(cls.vj_id.is_(None))
+        return not db.session.query(missing.exists()).scalar()
+
+
+class OutboxMessage(db.Model):
+    """
+    feed to publish in rabbitmq, written in the same transaction as the TripUpdates it comes from
+
+    the messages are published in order by the relay (see handler.publish_outbox), then deleted
+    """
+    __tablename__ = 'publication_outbox'
+    id = db.Column(db.BigInteger, primary_key=True)
+    created_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow, nullable=False)
+    contributor = db.Column(db.Text, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __init__(self, contributor, data):
+        self.contributor = contributor
+        self.data = data
+
+    @classmethod
+    def find_oldest(cls, limit):
+        """
+        return the oldest messages, locked until the end of the transaction
+        """
+        return cls.query.order_by(cls.id).limit(limit).with_for_update().all()
+
+    @classmethod
+    def delete_by_ids(cls, ids):
+        if ids:
+            cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
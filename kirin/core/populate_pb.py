@@ -28,6 +28,8 @@
 # www.navitia.io
 
 from kirin import gtfs_realtime_pb2, kirin_pb2, chaos_pb2
+from kirin.navitia_cache import LocalCache
+from flask import current_app
 import datetime
 
 
@@ -56,6 +58,83 @@ def convert_to_gtfsrt(trip_updates, incrementality = gtfs_realtime_pb2.FeedHeade
     return feed
 
 
+# FeedMessage.entity is the field 2, length delimited
+_FEED_ENTITY_KEY = chr((2 << 3) | 2)
+
+# the encoded entities, indexed by (vj_id, fingerprint) of their trip update
+_entity_cache = None
+
+
+def _get_entity_cache():
+    global _entity_cache
+    if _entity_cache is None:
+        # the entries never become stale (a change in the trip update changes its fingerprint), the ttl
+        # is there only to free the memory of the finished trips
+        _entity_cache = LocalCache(max_size=current_app.config.get('GTFSRT_ENTITY_CACHE_SIZE', 10000),
+                                   ttl=24 * 60 * 60)
+    return _entity_cache
+
+
+def _varint(value):
+    """
+    protobuf encoding of an unsigned int
+
+    >>> _varint(1)
+    '\\x01'
+    >>> _varint(300)
+    '\\xac\\x02'
+    """
+    res = []
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if not value:
+            res.append(chr(bits))
+            return ''.join(res)
+        res.append(chr(bits | 0x80))
+
+
+def encode_entity(trip_update):
+    """
+    encode the FeedEntity of a trip update as a field of a FeedMessage (with its key and its length)
+
+    the result is cached by vj_id and fingerprint, so an unchanged trip update is encoded only once
+    """
+    cache = _get_entity_cache() if trip_update.vj_id and trip_update.fingerprint else None
+    key = (trip_update.vj_id, trip_update.fingerprint)
+    if cache is not None and cache.max_size:
+        res = cache.get(key)
+        if res is not None:
+            return res
+
+    pb_entity = gtfs_realtime_pb2.FeedEntity()
+    fill_entity(pb_entity, trip_update)
+    data = pb_entity.SerializeToString()
+    res = _FEED_ENTITY_KEY + _varint(len(data)) + data
+
+    if cache is not None and cache.max_size:
+        cache.set(key, res)
+    return res
+
+
+def serialize_gtfsrt(trip_updates, incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL):
+    """
+    same as convert_to_gtfsrt(trip_updates, incrementality).SerializeToString()
+
+    the repeated fields of a protobuf message can be concatenated, so the message is made of the encoded header
+    followed by the cached encoded entities
+    """
+    return assemble_gtfsrt([encode_entity(trip_update) for trip_update in trip_updates], incrementality)
+
+
+def assemble_gtfsrt(encoded_entities, incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL):
+    """
+    serialized FeedMessage made of already encoded entities (see encode_entity)
+    """
+    header = convert_to_gtfsrt([], incrementality).SerializeToString()
+    return header + ''.join(encoded_entities)
+
+
 def get_st_event(st_status):
     if st_status == 'delete':
         return gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
@@ -0,0 +1,143 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+import time
+from collections import OrderedDict
+import gevent
+import gevent.event
+import gevent.lock
+from kirin.core.populate_pb import encode_entity
+from kirin.core.publisher import DeferredPublisher, record_latency
+from kirin.exceptions import MessageNotPublished
+
+# the publication classes, from the most urgent to the least
+PUBLICATION_CLASSES = ['cancellation', 'partial_deletion', 'large_delay', 'other']
+
+
+def publication_class(trip_update, delay_threshold):
+    """
+    class of the publication of a merged TripUpdate, delay_threshold being a timedelta
+    """
+    if trip_update.status == 'delete':
+        return 'cancellation'
+    stop_time_updates = trip_update.stop_time_updates
+    if any('delete' in (stu.departure_status, stu.arrival_status) for stu in stop_time_updates):
+        return 'partial_deletion'
+    if any(delay is not None and abs(delay) >= delay_threshold
+           for stu in stop_time_updates for delay in (stu.departure_delay, stu.arrival_delay)):
+        return 'large_delay'
+    return 'other'
+
+
+class PriorityPublisher(DeferredPublisher):
+    """
+    publish the trip updates through a lane by publication class, the most urgent lanes being published first
+
+    each lane holds at most lane_size trips, a trip being in only one lane with its latest state.
+    A greenlet publishes the trips of the most urgent lane, grouped by contributor in feeds of at most
+    batch_size trips, and measures the latency of each class (from the add to the publication)
+    """
+    def __init__(self, lane_size=1000, batch_size=100, timeout=5, publish=None):
+        super(PriorityPublisher, self).__init__(publish)
+        self.lane_size = lane_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # class -> OrderedDict((contributor, trip key) -> (encoded entity, added_at))
+        self._lanes = OrderedDict((c, OrderedDict()) for c in PUBLICATION_CLASSES)
+        # class -> free slots of the lane, released by publish_next
+        self._slots = {c: gevent.lock.Semaphore(lane_size) for c in PUBLICATION_CLASSES}
+        self._not_empty = gevent.event.Event()
+        self._greenlet = None
+        self.stats = {c: {'published': 0, 'errors': 0, 'last_latency': None, 'mean_latency': None,
+                          'max_latency': None} for c in PUBLICATION_CLASSES}
+
+    def add(self, contributor, trip_updates, delay_threshold):
+        """
+        put the trip updates in the lane of their class
+
+        if the lane is full, wait for some room, MessageNotPublished is raised after timeout seconds
+        """
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+        for trip_update in trip_updates:
+            self.add_entity(publication_class(trip_update, delay_threshold), contributor,
+                            trip_update.vj_id, encode_entity(trip_update))
+
+    def add_entity(self, publication_cls, contributor, trip_key, data):
+        key = (contributor, trip_key)
+        lane = self._lanes[publication_cls]
+        if key not in lane:
+            # the room is taken before touching the lanes: after a timeout, the waiting state of the trip is kept
+            if not self._slots[publication_cls].acquire(timeout=self.timeout):
+                self.stats[publication_cls]['errors'] += 1
+                raise MessageNotPublished('the {} publication lane is full'.format(publication_cls))
+            if key in lane:
+                # the trip has been added by another greenlet during the wait
+                self._slots[publication_cls].release()
+        # a waiting older state of the trip must not be published after this one
+        for other_cls, other_lane in self._lanes.items():
+            if other_cls != publication_cls and other_lane.pop(key, None) is not None:
+                self._slots[other_cls].release()
+        lane.pop(key, None)
+        lane[key] = (data, time.time())
+        self._not_empty.set()
+
+    def _run(self):
+        while True:
+            self._not_empty.clear()
+            if not self.publish_next():
+                self._not_empty.wait(1)
+
+    def publish_next(self):
+        """
+        publish one feed with the first trips of the most urgent lane, return its class (None if nothing to publish)
+        """
+        publication_cls, lane = next(((c, l) for c, l in self._lanes.items() if l), (None, None))
+        if publication_cls is None:
+            return None
+        contributor = next(iter(lane))[0]
+        keys = [k for k in lane if k[0] == contributor][:self.batch_size]
+        entities = [lane.pop(k) for k in keys]
+        for _ in entities:
+            self._slots[publication_cls].release()
+        stats = self.stats[publication_cls]
+        if not self._publish_entities([data for data, _ in entities], contributor):
+            stats['errors'] += len(entities)
+            return publication_cls
+        now = time.time()
+        for _, added_at in entities:
+            stats['published'] += 1
+            record_latency(stats, now - added_at)
+        return publication_cls
+
+    def info(self):
+        res = {}
+        for publication_cls, lane in self._lanes.items():
+            res[publication_cls] = dict(self.stats[publication_cls], queued=len(lane))
+        return res
@@ -0,0 +1,74 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+
+import logging
+from kirin.core.populate_pb import assemble_gtfsrt
+
+
+def record_latency(stats, latency):
+    """
+    update the 'last_latency', 'max_latency' and 'mean_latency' (exponentially weighted) of stats
+
+    >>> stats = {'last_latency': None, 'mean_latency': None, 'max_latency': None}
+    >>> record_latency(stats, 2.)
+    >>> record_latency(stats, 1.)
+    >>> stats['last_latency'], stats['max_latency'], round(stats['mean_latency'], 2)
+    (1.0, 2.0, 1.9)
+    """
+    stats['last_latency'] = latency
+    stats['max_latency'] = max(latency, stats['max_latency'])
+    mean = stats['mean_latency']
+    stats['mean_latency'] = latency if mean is None else 0.9 * mean + 0.1 * latency
+
+
+class DeferredPublisher(object):
+    """
+    base of the publishers sending the trip updates later, in feeds made of their encoded entities
+    """
+    def __init__(self, publish=None):
+        self._publish = publish
+
+    def _get_publish(self):
+        if self._publish is None:
+            from kirin.core.handler import publish
+            self._publish = publish
+        return self._publish
+
+    def _publish_entities(self, entities, contributor):
+        """
+        publish the encoded entities in one DIFFERENTIAL feed, return False if it failed
+        """
+        try:
+            self._get_publish()(assemble_gtfsrt(entities), contributor)
+            return True
+        except Exception:
+            # there is no one to report the error to, the trips will be sent again with the next full reload
+            logging.getLogger(__name__).exception('impossible to publish %s trips of %s', len(entities), contributor)
+            return False
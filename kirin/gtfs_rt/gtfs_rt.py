@@ -35,7 +35,7 @@ from google.protobuf.message import DecodeError
 from kirin import core
 from kirin.core import model
 from kirin.exceptions import KirinException, InvalidArguments
-from kirin.utils import make_navitia_wrapper, make_rt_update
+from kirin.utils import make_navitia_wrapper, make_rt_update, delay_rt_update
 from kirin.gtfs_rt.model_maker import KirinModelBuilder
 import navitia_wrapper
 from kirin.gtfs_rt import model_maker
@@ -68,7 +68,11 @@ class GtfsRT(Resource):
         except DecodeError:
             raise InvalidArguments('invalid protobuf')
 
-        proto.ParseFromString(raw_proto)
+        if current_app.config.get('ASYNC_INGESTION'):
+            # the raw protobuf is saved and will be handled by a worker
+            # a feed is about the whole network, all the feeds of the contributor go in the same lane
+            return delay_rt_update(raw_proto, 'gtfs-rt', dispatch_key=self.contributor)
+
         model_maker.handle(proto, self.navitia_wrapper, self.contributor)
 
         return 'OK', 200
@@ -29,34 +29,40 @@
 import datetime
 from kirin import gtfs_realtime_pb2
 import logging
+from collections import defaultdict
+import gevent.pool
+from flask.globals import current_app
 
+import kirin
 from kirin import core
 from kirin.core import model
 from kirin.exceptions import KirinException, InvalidArguments, ObjectNotFound
-from kirin.utils import make_navitia_wrapper, make_rt_update
+from kirin.utils import make_navitia_wrapper, make_rt_update, log_payload, save_rt_update_error
+from kirin.navitia_cache import get_or_build
 
 
 
 def handle(proto, navitia_wrapper, contributor):
-    data = str(proto)  # temp, for the moment, we save the protobuf as text
-    rt_update = make_rt_update(data, 'gtfs-rt')
+    rt_update = make_rt_update(proto.SerializeToString(), 'gtfs-rt')
+    handle_rt_update(rt_update, proto, navitia_wrapper, contributor)
+
+
+def handle_rt_update(rt_update, proto, navitia_wrapper, contributor):
+    """
+    handle the already persisted RealTimeUpdate, proto being its parsed raw data
+    """
     try:
         trip_updates = KirinModelBuilder(navitia_wrapper, contributor).build(rt_update, data=proto)
+        # the handling is in the error path too: with SINGLE_TRANSACTION_INGESTION a failure rolls back
+        # the RealTimeUpdate with the rest, and it has to be written again as KO
+        core.handle(rt_update, trip_updates, contributor)
     except KirinException as e:
-        rt_update.status = 'KO'
-        rt_update.error = e.data['error']
-        model.db.session.add(rt_update)
-        model.db.session.commit()
+        save_rt_update_error(rt_update, e.data.get('error', e.message))
         raise
     except Exception as e:
-        rt_update.status = 'KO'
-        rt_update.error = e.message
-        model.db.session.add(rt_update)
-        model.db.session.commit()
+        save_rt_update_error(rt_update, e.message)
         raise
 
-    core.handle(rt_update, trip_updates, contributor)
-
 
 def to_str(date):
     # the date is in UTC, thus we don't have to care about the coverage's timezone
@@ -64,6 +70,84 @@ def to_str(date):
     return date.strftime("%Y%m%dT%H%M%S")
 
 
+def floor_hour(dt):
+    """
+    >>> floor_hour(datetime.datetime(2012, 6, 15, 12, 42, 12))
+    datetime.datetime(2012, 6, 15, 12, 0)
+    """
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(dt):
+    """
+    >>> ceil_hour(datetime.datetime(2012, 6, 15, 12, 42, 12))
+    datetime.datetime(2012, 6, 15, 13, 0)
+    >>> ceil_hour(datetime.datetime(2012, 6, 15, 12, 0))
+    datetime.datetime(2012, 6, 15, 12, 0)
+    """
+    floor = floor_hour(dt)
+    return floor if floor == dt else floor + datetime.timedelta(hours=1)
+
+
+class StopPointCodeIndex(object):
+    """
+    index of the stop_times of a navitia vj by the codes of their stop_point
+
+    for each (code type, code value) we keep the positions in the vj of all the stop_times having this code
+    """
+    def __init__(self, navitia_vj):
+        self._stop_times = navitia_vj.get('stop_times', [])
+        self._positions = defaultdict(list)
+        for position, s in enumerate(self._stop_times):
+            codes = set((c['type'], c['value']) for c in s.get('stop_point', {}).get('codes', []))
+            for code in codes:
+                self._positions[code].append(position)
+
+    def find(self, code_type, code_value, after=-1):
+        """
+        return the position and the first stop_time with this code after the position 'after'
+        if there is none after this position, the first one is returned
+
+        >>> index = StopPointCodeIndex({'stop_times': [
+        ...     {'id': 'st:1', 'stop_point': {'codes': [{'type': 'source', 'value': 'A'}]}},
+        ...     {'id': 'st:2', 'stop_point': {'codes': [{'type': 'source', 'value': 'B'}]}},
+        ...     {'id': 'st:3', 'stop_point': {'codes': [{'type': 'source', 'value': 'A'}]}}
+        ... ]})
+        >>> pos, st = index.find('source', 'A')
+        >>> pos, st['id']
+        (0, 'st:1')
+        >>> pos, st = index.find('source', 'A', after=1)
+        >>> pos, st['id']
+        (2, 'st:3')
+        >>> pos, st = index.find('source', 'B', after=2)
+        >>> pos, st['id']
+        (1, 'st:2')
+        >>> index.find('other_source', 'A')
+        (None, None)
+        """
+        positions = self._positions.get((code_type, code_value))
+        if not positions:
+            return None, None
+        position = next((p for p in positions if p > after), positions[0])
+        return position, self._stop_times[position]
+
+
+_navitia_pools = {}
+
+
+def get_navitia_pool(contributor):
+    """
+    return the greenlet pool used to query navitia for a contributor
+
+    the pool is shared by all the feeds of the contributor to bound the number of concurrent calls to navitia
+    """
+    pool = _navitia_pools.get(contributor)
+    if pool is None:
+        pool = gevent.pool.Pool(current_app.config.get('GTFS_RT_NAVITIA_CONCURRENCY', 10))
+        _navitia_pools[contributor] = pool
+    return pool
+
+
 class KirinModelBuilder(object):
 
     def __init__(self, nav, contributor=None):
@@ -81,31 +165,45 @@ class KirinModelBuilder(object):
 
         The TripUpdates are not yet associated with the RealTimeUpdate
         """
-        self.log.info("proto = {}".format(data))
+        log_payload('gtfs-rt feed', data, self.contributor)
         data_time = datetime.datetime.utcfromtimestamp(data.header.timestamp)
 
+        input_trip_updates = [entity.trip_update for entity in data.entity if entity.trip_update]
+
+        # the vjs are searched concurrently in navitia, the order of the results is kept by the pool.
+        # A vj not found only skips its trip, but a navitia error fails the whole feed (saved as KO),
+        # so it is handled again at the next poll
+        pool = get_navitia_pool(self.contributor)
+        vjs_by_trip_update = pool.map(lambda tu: self._get_navitia_vjs(tu.trip, data_time=data_time),
+                                      input_trip_updates)
+
         trip_updates = []
-        for entity in data.entity:
-            if not entity.trip_update:
-                continue
-            tu = self._make_trip_updates(entity.trip_update, data_time=data_time)
+        for input_trip_update, vjs in zip(input_trip_updates, vjs_by_trip_update):
+            tu = self._make_trip_updates(input_trip_update, vjs)
             trip_updates.extend(tu)
 
         return trip_updates
 
-    def _make_trip_updates(self, input_trip_update, data_time):
-        vjs = self._get_navitia_vjs(input_trip_update.trip, data_time=data_time)
-
+    def _make_trip_updates(self, input_trip_update, vjs):
         trip_updates = []
         for vj in vjs:
             trip_update = model.TripUpdate(vj=vj)
             trip_update.contributor = self.contributor
             trip_updates.append(trip_update)
 
+            # the stop_time_updates are ordered by stop_sequence, so each one is searched after the
+            # previous one in the vj, this way the right stop_time is found even for loops.
+            # Its position is given to the StopTimeUpdate for the merge
+            last_position = -1
             for input_st_update in input_trip_update.stop_time_update:
-                st_update = self._make_stoptime_update(input_st_update, vj.navitia_vj)
-                if not st_update:
+                position, nav_st = self._get_navitia_stop_time(input_st_update, vj.navitia_vj, last_position)
+                if nav_st is None:
+                    self.log.debug('impossible to find stop point {} in the vj {}, skipping it'.format(
+                        input_st_update.stop_id, vj.navitia_vj.get('id')))
                     continue
+                last_position = position
+                st_update = self._make_stoptime_update(input_st_update, nav_st)
+                st_update.vj_position = position
                 trip_update.stop_time_updates.append(st_update)
 
         return trip_updates
@@ -113,11 +211,13 @@ class KirinModelBuilder(object):
     def _get_navitia_vjs(self, trip, data_time):
         vj_source_code = trip.trip_id
 
-        since = data_time - self.period_filter_tolerance
-        until = data_time + self.period_filter_tolerance
+        # the period is rounded to the hour to query navitia the same way (and thus hit the cache)
+        # between 2 polls of the feed
+        since = floor_hour(data_time - self.period_filter_tolerance)
+        until = ceil_hour(data_time + self.period_filter_tolerance)
         self.log.debug('searching for vj {} on [{}, {}[ in navitia'.format(vj_source_code, since, until))
 
-        navitia_vjs = self.navitia.vehicle_journeys(q={
+        navitia_vjs = kirin.navitia_vj_cache.vehicle_journeys(self.navitia, q={
             'filter': 'vehicle_journey.has_code({}, {})'.format(self.stop_code_key, vj_source_code),
             'since': to_str(since),
             'until': to_str(until),
@@ -132,14 +232,7 @@ class KirinModelBuilder(object):
 
         return [model.VehicleJourney(nav_vj, since.date()) for nav_vj in navitia_vjs]
 
-    def _make_stoptime_update(self, input_st_update, navitia_vj):
-        nav_st = self._get_navitia_stop_time(input_st_update, navitia_vj)
-
-        if nav_st is None:
-            self.log.debug('impossible to find stop point {} in the vj {}, skipping it'.format(
-                input_st_update.stop_id, navitia_vj.get('id')))
-            return None
-
+    def _make_stoptime_update(self, input_st_update, nav_st):
         nav_stop = nav_st.get('stop_point', {})
 
         # TODO handle delay uncertainty
@@ -158,10 +251,9 @@ class KirinModelBuilder(object):
 
         return st_update
 
-    def _get_navitia_stop_time(self, input_st_update, navitia_vj):
-        # TODO use input_st_update.stop_sequence to get the right stop_time even for loops
-        for s in navitia_vj.get('stop_times', []):
-            if any(c['type'] == self.stop_code_key and c['value'] == input_st_update.stop_id
-                   for c in s.get('stop_point', {}).get('codes', [])):
-                return s
-        return None
+    def _get_navitia_stop_time(self, input_st_update, navitia_vj, after=-1):
+        """
+        return the position in the vj and the navitia stop_time of the stop_time_update
+        """
+        index = get_or_build(navitia_vj, 'stop_point_code_index', StopPointCodeIndex)
+        return index.find(self.stop_code_key, input_st_update.stop_id, after)
@@ -27,6 +27,7 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
+import hashlib
 import logging
 from kirin.core import model
 
@@ -46,19 +47,64 @@ from google.protobuf.message import DecodeError
 class InvalidFeed(Exception):
     pass
 
+
+# state of the last feed handled for each feed url, to avoid handling the same feed twice
+_last_feeds = {}
+
+
+def _log_outcome(config, outcome):
+    """
+    the outcome of the polling is also given in the 'outcome' field of the log record for the metrics
+    """
+    logging.getLogger(__name__).info('gtfs-rt polling of %s: %s', config['feed_url'], outcome,
+                                     extra={'contributor': config['contributor'], 'outcome': outcome})
+
+
 @celery.task(bind=True)
 def gtfs_poller(self, config):
+    """
+    poll the gtfs-rt feed and handle it
+
+    if the feed has not changed since the last poll (same http validators, same content or same timestamp)
+    nothing is done
+    """
     logger =  logging.LoggerAdapter(logging.getLogger(__name__), extra={'contributor': config['contributor']})
     logger.debug('polling of %s', config['feed_url'])
-    response = requests.get(config['feed_url'], timeout=config.get('timeout', 1))
+    last_feed = _last_feeds.get(config['feed_url'], {})
+    headers = {}
+    if last_feed.get('etag'):
+        headers['If-None-Match'] = last_feed['etag']
+    if last_feed.get('last_modified'):
+        headers['If-Modified-Since'] = last_feed['last_modified']
+    response = requests.get(config['feed_url'], timeout=config.get('timeout', 1), headers=headers)
+    if response.status_code == 304:
+        _log_outcome(config, 'not_modified')
+        return
     response.raise_for_status()
 
+    content_hash = hashlib.sha1(response.content).hexdigest()
+    if content_hash == last_feed.get('content_hash'):
+        _log_outcome(config, 'unchanged')
+        return
+
+    proto = gtfs_realtime_pb2.FeedMessage()
+    proto.ParseFromString(response.content)
+    if proto.header.timestamp and proto.header.timestamp == last_feed.get('timestamp'):
+        _log_outcome(config, 'unchanged')
+        return
+
     nav = navitia_wrapper.Navitia(url=config['navitia_url'], token=config['token'])\
                          .instance(config['coverage'])
     nav.timeout = 5
 
-    proto = gtfs_realtime_pb2.FeedMessage()
-    proto.ParseFromString(response.content)
     model_maker.handle(proto, nav, config['contributor'])
-    logger.debug('gtfsrt polling finished')
 
+    # the feed is remembered only once it has been correctly handled
+    _last_feeds[config['feed_url']] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_hash': content_hash,
+        'timestamp': proto.header.timestamp,
+    }
+    _log_outcome(config, 'handled')
+    logger.debug('gtfsrt polling finished')
@@ -31,9 +31,9 @@ from flask.globals import current_app
 from flask_restful import Resource
 
 from kirin import core
-from kirin.core import model
 from kirin.exceptions import KirinException, InvalidArguments
-from kirin.utils import make_navitia_wrapper, make_rt_update
+from kirin.utils import make_navitia_wrapper, make_rt_update, delay_rt_update, save_rt_update_error
+import model_maker
 from model_maker import KirinModelBuilder
 
 
@@ -46,6 +46,24 @@ def get_ire(req):
     return req.data
 
 
+def handle(rt_update, navitia_wrapper, contributor):
+    """
+    interpret the raw xml of the RealTimeUpdate and handle the trip updates
+    """
+    try:
+        # raw_xml is interpreted
+        trip_updates = KirinModelBuilder(navitia_wrapper, contributor).build(rt_update)
+        # the handling is in the error path too: with SINGLE_TRANSACTION_INGESTION a failure rolls back
+        # the RealTimeUpdate with the rest, and it has to be written again as KO
+        core.handle(rt_update, trip_updates, contributor)
+    except KirinException as e:
+        save_rt_update_error(rt_update, e.data.get('error', e.message))
+        raise
+    except Exception as e:
+        save_rt_update_error(rt_update, e.message)
+        raise
+
+
 class Ire(Resource):
 
     def __init__(self):
@@ -56,27 +74,12 @@ class Ire(Resource):
     def post(self):
         raw_xml = get_ire(flask.globals.request)
 
+        if current_app.config.get('ASYNC_INGESTION'):
+            # the raw_xml is saved and will be handled by a worker
+            return delay_rt_update(raw_xml, 'ire', dispatch_key=model_maker.dispatch_key(raw_xml))
+
         # create a raw ire obj, save the raw_xml into the db
         rt_update = make_rt_update(raw_xml, 'ire')
-        try:
-            # assuming UTF-8 encoding for all ire input
-            rt_update.raw_data = rt_update.raw_data.encode('utf-8')
-
-            # raw_xml is interpreted
-            trip_updates = KirinModelBuilder(self.navitia_wrapper, self.contributor).build(rt_update)
-        except KirinException as e:
-            rt_update.status = 'KO'
-            rt_update.error = e.data['error']
-            model.db.session.add(rt_update)
-            model.db.session.commit()
-            raise
-        except Exception as e:
-            rt_update.status = 'KO'
-            rt_update.error = e.message
-            model.db.session.add(rt_update)
-            model.db.session.commit()
-            raise
-
-        core.handle(rt_update, trip_updates, current_app.config['CONTRIBUTOR'])
+        handle(rt_update, self.navitia_wrapper, self.contributor)
 
         return 'OK', 200
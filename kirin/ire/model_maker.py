@@ -29,10 +29,13 @@
 # www.navitia.io
 import itertools
 import logging
+from collections import defaultdict
 from datetime import timedelta, datetime
 from dateutil import parser
 from flask.globals import current_app
+import kirin
 from kirin.core import model
+from kirin.navitia_cache import get_or_build
 # For perf benches:
 # http://effbot.org/zone/celementtree.htm
 import xml.etree.cElementTree as ElementTree
@@ -128,6 +131,58 @@ def get_navitia_stop_time(navitia_vj, stop_id):
     return nav_st
 
 
+class StopCodeIndex(object):
+    """
+    index of the stop_times of a navitia vj by the CR-CI-CH code of their stop_area
+
+    a vj can pass several times by the same stop_area (for lollipop lines for example),
+    so for each code we keep the positions in the vj of all the stop_times, in the vj's order
+    """
+    def __init__(self, navitia_vj):
+        self._stop_times = defaultdict(list)
+        for position, s in enumerate(navitia_vj.get('stop_times', [])):
+            codes = set(c['value'] for c in s.get('stop_point', {}).get('stop_area', {}).get('codes', [])
+                        if c['type'] == 'CR-CI-CH')
+            for code in codes:
+                self._stop_times[code].append((position, s))
+
+    def find(self, code):
+        """
+        return the list of the positions and stop_times with this CR-CI-CH code
+
+        >>> index = StopCodeIndex({'stop_times': [
+        ...     {'id': 'st:1', 'stop_point': {'stop_area': {'codes': [{'type': 'CR-CI-CH', 'value': '1-2-3'}]}}},
+        ...     {'id': 'st:2', 'stop_point': {'stop_area': {'codes': [{'type': 'UIC', 'value': '1-2-3'}]}}},
+        ...     {'id': 'st:3', 'stop_point': {'stop_area': {'codes': [{'type': 'CR-CI-CH', 'value': '1-2-3'}]}}}
+        ... ]})
+        >>> [(pos, st['id']) for pos, st in index.find('1-2-3')]
+        [(0, 'st:1'), (2, 'st:3')]
+        >>> index.find('4-5-6')
+        []
+        """
+        return self._stop_times.get(code, [])
+
+
+def dispatch_key(raw_xml):
+    """
+    key used to dispatch the ire of the same train in the same ingestion lane: the train number and its departure
+
+    None if the xml is invalid (the error is raised when the ire is handled)
+
+    >>> dispatch_key('<InfoRetard><Train><NumeroTrain>96231</NumeroTrain><OrigineTheoriqueTrain>'
+    ...              '<DateHeureDepart>2015-09-21T17:21:00</DateHeureDepart></OrigineTheoriqueTrain>'
+    ...              '</Train></InfoRetard>')
+    '96231|2015-09-21T17:21:00'
+    >>> dispatch_key('<bob></bob>')
+    """
+    try:
+        xml_train = ElementTree.fromstring(raw_xml).find('Train')
+        return '{}|{}'.format(xml_train.findtext('NumeroTrain'),
+                              xml_train.findtext('OrigineTheoriqueTrain/DateHeureDepart'))
+    except Exception:
+        return None
+
+
 class KirinModelBuilder(object):
 
     def __init__(self, nav, contributor=None):
@@ -173,7 +228,7 @@ class KirinModelBuilder(object):
 
             log.debug('searching for vj {} on {} in navitia'.format(train_number, vj_start))
 
-            navitia_vjs = self.navitia.vehicle_journeys(q={
+            navitia_vjs = kirin.navitia_vj_cache.vehicle_journeys(self.navitia, q={
                 'headsign': train_number,
                 'since': to_str(since),
                 'until': to_str(until),
@@ -206,11 +261,14 @@ class KirinModelBuilder(object):
         delay = xml_modification.find('HoraireProjete')
         if delay:
             trip_update.status = 'update'
+            # the points are in the order of the train's path, so the n-th time a stop is found
+            # it is its n-th stop_time in the vj (for lollipop lines for example)
+            nb_occurrences = defaultdict(int)
             for downstream_point in delay.iter('PointAval'):
                 # we need only to consider the station
                 if not as_bool(get_value(downstream_point, 'IndicateurPRGare')):
                     continue
-                nav_st = self._get_navitia_stop_time(downstream_point, vj.navitia_vj)
+                position, nav_st = self._get_navitia_stop_time(downstream_point, vj.navitia_vj, nb_occurrences)
 
                 if nav_st is None:
                     continue
@@ -223,6 +281,7 @@ class KirinModelBuilder(object):
                 message = get_value(downstream_point, 'MotifExterne', nullabe=True)
                 st_update = model.StopTimeUpdate(nav_stop, departure_delay=dep_delay, arrival_delay=arr_delay,
                                                  dep_status=dep_status, arr_status=arr_status, message=message)
+                st_update.vj_position = position
                 trip_update.stop_time_updates.append(st_update)
 
         removal = xml_modification.find('Suppression')
@@ -237,11 +296,12 @@ class KirinModelBuilder(object):
                 deleted_points = itertools.chain([removal.find('PRDebut')],
                                                  removal.iter('PointSupprime'),
                                                  [removal.find('PRFin')])
+                nb_occurrences = defaultdict(int)
                 for deleted_point in deleted_points:
                     # we need only to consider the stations
                     if not as_bool(get_value(deleted_point, 'IndicateurPRGare')):
                         continue
-                    nav_st = self._get_navitia_stop_time(deleted_point, vj.navitia_vj)
+                    position, nav_st = self._get_navitia_stop_time(deleted_point, vj.navitia_vj, nb_occurrences)
 
                     if nav_st is None:
                         continue
@@ -259,6 +319,7 @@ class KirinModelBuilder(object):
                     message = get_value(deleted_point, 'MotifExterne', nullabe=True)
                     st_update = model.StopTimeUpdate(nav_stop, dep_status=dep_status, arr_status=arr_status,
                                                      message=message)
+                    st_update.vj_position = position
                     trip_update.stop_time_updates.append(st_update)
 
             if xml_prdebut:
@@ -267,13 +328,14 @@ class KirinModelBuilder(object):
         return trip_update
 
     @staticmethod
-    def _get_navitia_stop_time(downstream_point, nav_vj):
+    def _get_navitia_stop_time(downstream_point, nav_vj, nb_occurrences):
         """
-        get a navitia stop from an xml node
+        get the position in the vj and the navitia stop_time of an xml node
         the xml node MUST contains a CR, CI, CH tags
 
         it searchs in the vj's stops for a stop_area with the external code
-        CR-CI-CH
+        CR-CI-CH. nb_occurrences holds the number of times each code has already been found in the
+        previous nodes, so the stop_time of the same occurrence of the stop is taken in the vj
         """
         cr = get_value(downstream_point, 'CRPR')
         ci = get_value(downstream_point, 'CIPR')
@@ -281,24 +343,22 @@ class KirinModelBuilder(object):
 
         nav_external_code = "{cr}-{ci}-{ch}".format(cr=cr, ci=ci, ch=ch)
 
-        nav_stop_times = []
-        for s in nav_vj.get('stop_times', []):
-            for c in s.get('stop_point', {}).get('stop_area', {}).get('codes', []):
-                if c['value'] == nav_external_code and c['type'] == 'CR-CI-CH':
-                    nav_stop_times.append(s)
-                    break
+        index = get_or_build(nav_vj, 'stop_code_index', StopCodeIndex)
+        nav_stop_times = index.find(nav_external_code)
+        occurrence = nb_occurrences[nav_external_code]
+        nb_occurrences[nav_external_code] += 1
 
         if not nav_stop_times:
             logging.getLogger(__name__).info('impossible to find stop "{}" in the vj, skipping it'
                                              .format(nav_external_code))
-            return None
+            return None, None
 
-        if len(nav_stop_times) > 1:
-            logging.getLogger(__name__).warning('too many stops found for code "{}" in the vj, '
-                                                'we take the first one'
+        if occurrence >= len(nav_stop_times):
+            logging.getLogger(__name__).warning('stop "{}" found more times than the vj serves it, skipping it'
                                                 .format(nav_external_code))
+            return None, None
 
-        return nav_stop_times[0]
+        return nav_stop_times[occurrence]
 
     @staticmethod
     def _get_delay(xml):
@@ -0,0 +1,190 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import hashlib
+import logging
+import time
+import cPickle as pickle
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    in-process LRU cache, each entry has its own time to live
+    """
+    def __init__(self, max_size=1000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at < time.time():
+            return None
+        # we put it back at the end to keep it as the most recently used
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        return {'backend': 'local', 'size': len(self), 'max_size': self.max_size, 'ttl': self.ttl}
+
+
+class RedisCache(object):
+    """
+    cache shared between all the kirin processes
+
+    the LRU eviction is left to redis (it needs to be configured with a 'maxmemory-policy allkeys-lru')
+    since the navitia responses contains datetime objects, they are pickled
+    """
+    def __init__(self, url, ttl=600, prefix='kirin.navitia.'):
+        import redis  # redis is only needed for this backend
+        self._redis = redis.StrictRedis.from_url(url)
+        self._errors = (redis.RedisError,)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            raw = self._redis.get(self.prefix + key)
+        except self._errors:
+            logging.getLogger(__name__).exception('impossible to read from redis')
+            return None
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            self._redis.setex(self.prefix + key, ttl, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except self._errors:
+            logging.getLogger(__name__).exception('impossible to write in redis')
+
+    def info(self):
+        return {'backend': 'redis', 'ttl': self.ttl}
+
+
+def make_key(url, collection, q):
+    """
+    normalize a navitia query as a cache key: the parameters order does not matter
+
+    >>> make_key('http://bob/', 'vehicle_journeys', {'since': '20151005T120000', 'headsign': '96231'}) == \\
+    ...     make_key('http://bob/', 'vehicle_journeys', {'headsign': '96231', 'since': '20151005T120000'})
+    True
+    """
+    params = '&'.join('{}={}'.format(k, v) for k, v in sorted((q or {}).items()))
+    return hashlib.sha1('{}{}?{}'.format(url, collection, params)).hexdigest()
+
+
+def get_or_build(navitia_obj, name, builder):
+    """
+    return some data derived from a navitia object (like an index on it), built only once
+
+    the derived data is stored in the navitia object, so it lives as long as the object is cached
+
+    >>> get_or_build({'id': 'vj:1'}, 'upper_id', lambda vj: vj['id'].upper())
+    'VJ:1'
+    """
+    key = '_kirin_' + name
+    res = navitia_obj.get(key)
+    if res is None:
+        res = builder(navitia_obj)
+        navitia_obj[key] = res
+    return res
+
+
+class NavitiaCache(object):
+    """
+    cache of the navitia responses used by the model makers
+
+    without backend all the calls are forwarded to navitia.
+    Note: the cached responses are shared, they must not be modified
+    (except to attach derived data with get_or_build)
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def vehicle_journeys(self, navitia, q):
+        if self.backend is None:
+            return navitia.vehicle_journeys(q=q)
+
+        key = make_key(getattr(navitia, 'url', ''), 'vehicle_journeys', q)
+        res = self.backend.get(key)
+        if res is not None:
+            self.hits += 1
+            return res
+
+        self.misses += 1
+        res = navitia.vehicle_journeys(q=q)
+        # we don't cache empty responses, the vj might be available soon in navitia
+        if res:
+            self.backend.set(key, res)
+        return res
+
+    def info(self):
+        if self.backend is None:
+            return {'backend': None}
+        res = self.backend.info()
+        res.update({'hits': self.hits, 'misses': self.misses})
+        return res
+
+
+def make_navitia_cache(config):
+    """
+    build the navitia cache from the configuration
+
+    NAVITIA_CACHE_BACKEND can be:
+        * 'local': in-process cache
+        * 'redis': cache shared between the kirin processes,
+            if redis is not available we fall back on the in-process cache
+        * None: no cache
+    """
+    backend = config.get('NAVITIA_CACHE_BACKEND')
+    ttl = config.get('NAVITIA_CACHE_TTL', 600)
+    if backend == 'redis':
+        try:
+            return NavitiaCache(RedisCache(config['NAVITIA_CACHE_REDIS_URL'], ttl=ttl))
+        except ImportError:
+            logging.getLogger(__name__).warning('redis is not installed, using a local navitia cache')
+            backend = 'local'
+    if backend == 'local':
+        return NavitiaCache(LocalCache(max_size=config.get('NAVITIA_CACHE_MAX_SIZE', 1000), ttl=ttl))
+    return NavitiaCache()
@@ -26,28 +26,193 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
-from kombu import BrokerConnection, Exchange, Queue, Consumer
+from kombu import BrokerConnection, Exchange, Queue, Consumer, Producer
 from kombu.pools import producers, connections
 import logging
 from amqp.exceptions import ConnectionForced
 import gevent
+import gevent.queue
+from gevent.event import AsyncResult
 from retrying import retry
 from kirin import task_pb2
 from google.protobuf.message import DecodeError
 import socket
-from kirin.core.model import TripUpdate, db
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.model import TripUpdate, FeedEntitySnapshot, db
+from sqlalchemy.orm import Session
+from kirin.core.populate_pb import serialize_gtfsrt, assemble_gtfsrt
+from kirin.core.publisher import record_latency
 import gtfs_realtime_pb2
-from kirin.utils import str_to_date
+from kirin.utils import str_to_date, log_payload
 from socket import error
 import time
+import math
+from collections import OrderedDict
+
+
+class PublishNotConfirmed(Exception):
+    pass
+
+
+class ConfirmedPublisher(object):
+    """
+    publisher using the confirms of the broker, on its own connection
+
+    the messages to publish are queued and sent by a dedicated greenlet, with at most max_in_flight
+    messages waiting for their confirm at the same time, so concurrent publications do not wait
+    for each other's round trip. The queued messages are sent grouped by routing key.
+    The exchange is declared once by connection, and the greenlet does the heartbeats of its connection.
+    """
+    def __init__(self, connection_string, exchange, max_in_flight=100, confirm_timeout=5):
+        self._connection_string = connection_string
+        self._exchange = exchange
+        self.max_in_flight = max_in_flight
+        self.confirm_timeout = confirm_timeout
+        self._queue = gevent.queue.Queue()
+        self._in_flight = OrderedDict()  # delivery tag -> (AsyncResult, sent_at)
+        self._connection = None
+        self._producer = None
+        self._next_tag = 0
+        self._next_heartbeat = 0
+        self._greenlet = None
+        self.stats = {'published': 0, 'nacked': 0, 'errors': 0,
+                      'last_latency': None, 'mean_latency': None, 'max_latency': None}
+
+    def publish(self, item, routing_key):
+        """
+        publish the message and wait for its confirm
+
+        raise PublishNotConfirmed if the broker refuses it, does not confirm it in time or if the connection is lost
+        """
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+        result = AsyncResult()
+        self._queue.put((routing_key, item, result))
+        try:
+            result.get(timeout=self.confirm_timeout)
+        except gevent.Timeout:
+            error = PublishNotConfirmed('message not confirmed after {}s'.format(self.confirm_timeout))
+            # the message is abandoned, it will not be sent if it is still queued
+            result.set_exception(error)
+            raise error
+
+    def info(self):
+        res = {'in_flight': len(self._in_flight), 'queued': self._queue.qsize(), 'max_in_flight': self.max_in_flight}
+        res.update(self.stats)
+        return res
+
+    def _run(self):
+        while True:
+            try:
+                if self._connection is None:
+                    self._connect()
+                self._send_batch()
+                if self._in_flight:
+                    try:
+                        # the confirms are received while waiting for the events of the connection,
+                        # the messages queued meanwhile are sent with the next batch
+                        self._connection.drain_events(timeout=1)
+                    except socket.timeout:
+                        pass
+                # the loop runs at least once a second, it is enough for the heartbeats
+                self._heartbeat()
+            except Exception as e:
+                logging.getLogger(__name__).exception('publisher connection lost')
+                self._fail_in_flight(e)
+                self._close()
+                gevent.sleep(1)
+
+    def _connect(self):
+        self._connection = BrokerConnection(self._connection_string)
+        channel = self._connection.channel()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._on_ack)
+        channel.events['basic_nack'].add(self._on_nack)
+        # the exchange is declared here, once for this connection
+        self._producer = Producer(channel, exchange=self._exchange, auto_declare=True)
+        self._next_tag = 0
+        self._next_heartbeat = 0
+
+    def _heartbeat(self):
+        """
+        send and check the heartbeats of the connection, twice by heartbeat interval
+        """
+        now = time.time()
+        if not self._connection.heartbeat or now < self._next_heartbeat:
+            return
+        self._next_heartbeat = now + self._connection.heartbeat / 2.
+        try:
+            # the heartbeats of the broker need to be read to be checked, even when nothing is in flight
+            self._connection.drain_events(timeout=0.01)
+        except socket.timeout:
+            pass
+        self._connection.heartbeat_check(rate=2)
+
+    def _close(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.release()
+        except Exception:
+            pass
+        self._connection = self._producer = None
+
+    def _send_batch(self):
+        """
+        send the queued messages as long as the in-flight window is not full
+        """
+        batch = []
+        while len(batch) < self.max_in_flight - len(self._in_flight):
+            try:
+                # if nothing is waiting for a confirm, we wait for a message to send
+                wait = not self._in_flight and not batch
+                batch.append(self._queue.get(block=wait, timeout=1 if wait else None))
+            except gevent.queue.Empty:
+                break
+        # the sort is stable, so the order of the messages of a routing key is kept
+        batch = [m for m in sorted(batch, key=lambda m: m[0]) if not m[2].ready()]
+        for i, (routing_key, item, result) in enumerate(batch):
+            try:
+                self._producer.publish(item, routing_key=routing_key)
+            except Exception as e:
+                # the messages not sent are failed, the connection will be reset by _run
+                for _, _, r in batch[i:]:
+                    self.stats['errors'] += 1
+                    r.set_exception(PublishNotConfirmed('message not sent: {}'.format(e)))
+                raise
+            self._next_tag += 1
+            self._in_flight[self._next_tag] = (result, time.time())
+
+    def _confirmed(self, delivery_tag, multiple):
+        tags = [t for t in self._in_flight if t <= delivery_tag] if multiple else [delivery_tag]
+        return [self._in_flight.pop(t) for t in tags if t in self._in_flight]
+
+    def _on_ack(self, delivery_tag, multiple=False):
+        now = time.time()
+        for result, sent_at in self._confirmed(delivery_tag, multiple):
+            self.stats['published'] += 1
+            record_latency(self.stats, now - sent_at)
+            result.set()
+
+    def _on_nack(self, delivery_tag, multiple=False):
+        for result, _ in self._confirmed(delivery_tag, multiple):
+            self.stats['nacked'] += 1
+            result.set_exception(PublishNotConfirmed('message refused by the broker'))
+
+    def _fail_in_flight(self, error):
+        for result, _ in self._in_flight.values():
+            self.stats['errors'] += 1
+            result.set_exception(PublishNotConfirmed('connection lost: {}'.format(error)))
+        self._in_flight.clear()
 
 
 class RabbitMQHandler(object):
-    def __init__(self, connection_string, exchange):
+    def __init__(self, connection_string, exchange, confirms=False, max_in_flight=100, confirm_timeout=5):
         self._connection = BrokerConnection(connection_string)
         self._connections = set([self._connection])  # set of connection for the heartbeat
         self._exchange = Exchange(exchange, durable=True, delivry_mode=2, type='topic')
+        self._publisher = None
+        if confirms:
+            self._publisher = ConfirmedPublisher(connection_string, self._exchange, max_in_flight, confirm_timeout)
         monitor_heartbeats(self._connections)
 
     def _get_producer(self):
@@ -55,8 +220,13 @@ class RabbitMQHandler(object):
         self._connections.add(producer.connection)
         return producer
 
-    @retry(wait_fixed=200, stop_max_attempt_number=3)
+    # a message not confirmed is not retried: it might have been sent, and its publication already took too long
+    @retry(wait_fixed=200, stop_max_attempt_number=3,
+           retry_on_exception=lambda e: not isinstance(e, PublishNotConfirmed))
     def publish(self, item, contributor):
+        if self._publisher:
+            self._publisher.publish(item, contributor)
+            return
         with self._get_producer() as producer:
             producer.publish(item, exchange=self._exchange, routing_key=contributor, declare=[self._exchange])
 
@@ -67,9 +237,109 @@ class RabbitMQHandler(object):
             res = producer.connection.info()
             if 'password' in res:
                 del res['password']
+            if self._publisher:
+                res['publisher'] = self._publisher.info()
             return res
 
-    def listen_load_realtime(self, queue_name, retry_timeout=10):
+    def _publish_full_feed_by_chunks(self, load_realtime, begin_date, end_date, chunk_size):
+        """
+        publish the full dataset as several feeds of at most chunk_size trip updates
+
+        each message has a 'sequence' and a 'total' header.
+        The first feed is a FULL_DATASET and the next ones are DIFFERENTIAL, so applying them in
+        sequence gives the whole dataset.
+        """
+        log = logging.getLogger(__name__)
+        contributors = load_realtime.contributors
+        # the count and the export need to see the same data, even if trip updates are written meanwhile,
+        # so they are done in their own REPEATABLE READ transaction
+        connection = db.engine.connect().execution_options(isolation_level='REPEATABLE READ')
+        session = Session(bind=connection)
+        try:
+            nb_trip_updates = TripUpdate.count_by_contributor_period(contributors, begin_date, end_date, session)
+            total = max(1, int(math.ceil(nb_trip_updates / float(chunk_size))))
+            chunks = TripUpdate.find_by_contributor_period_by_chunks(contributors, begin_date, end_date,
+                                                                     chunk_size=chunk_size, session=session)
+            if not nb_trip_updates:
+                chunks = [[]]  # we still need to send an empty feed
+
+            with self._get_producer() as producer:
+                log.info('Publishing full feed ({} trip updates in {} chunks)...'.format(nb_trip_updates, total))
+                for sequence, trip_updates in enumerate(chunks):
+                    incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET if sequence == 0 \
+                        else gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+                    feed = serialize_gtfsrt(trip_updates, incrementality)
+                    producer.publish(feed, routing_key=load_realtime.queue_name,
+                                     headers={'sequence': sequence, 'total': total})
+                log.info('Full feed published.')
+        finally:
+            session.close()
+            connection.close()
+
+    def _publish_full_feed_from_snapshot(self, load_realtime, begin_date, end_date, chunk_size=None):
+        """
+        publish the full dataset made of the encoded entities of the snapshot (no TripUpdate is loaded)
+
+        if chunk_size is given, it is split in several feeds like in _publish_full_feed_by_chunks
+        """
+        log = logging.getLogger(__name__)
+        entities = FeedEntitySnapshot.find_data_by_contributor_period(load_realtime.contributors,
+                                                                      begin_date, end_date)
+        if not chunk_size:
+            chunks = [entities]
+        else:
+            chunks = [entities[i:i + chunk_size] for i in range(0, len(entities), chunk_size)] or [[]]
+
+        with self._get_producer() as producer:
+            log.info('Publishing full feed from the snapshot ({} trip updates in {} chunks)...'
+                     .format(len(entities), len(chunks)))
+            for sequence, chunk in enumerate(chunks):
+                incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET if sequence == 0 \
+                    else gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+                headers = {'sequence': sequence, 'total': len(chunks)} if chunk_size else None
+                producer.publish(assemble_gtfsrt(chunk, incrementality), routing_key=load_realtime.queue_name,
+                                 headers=headers)
+            log.info('Full feed published.')
+
+    def _publish_full_feed(self, load_realtime, begin_date, end_date, chunk_size=None, use_snapshot=False):
+        """
+        publish the full dataset requested by load_realtime
+
+        the snapshot is only used for the whole dataset (no date range asked for) and once it has been
+        initialized by build_feed_snapshot, otherwise the feed is made from the TripUpdates
+        """
+        log = logging.getLogger(__name__)
+        if use_snapshot:
+            if begin_date or end_date:
+                log.info('date range asked for, the full feed is not made from the snapshot')
+            elif not FeedEntitySnapshot.is_complete(load_realtime.contributors):
+                log.warning('the snapshot is not initialized (build_feed_snapshot has not been run), '
+                            'the full feed is not made from it')
+            else:
+                self._publish_full_feed_from_snapshot(load_realtime, begin_date, end_date, chunk_size)
+                return
+        if chunk_size:
+            self._publish_full_feed_by_chunks(load_realtime, begin_date, end_date, chunk_size)
+            return
+
+        feed = serialize_gtfsrt(TripUpdate.find_by_contributor_period(load_realtime.contributors,
+                                                                      begin_date,
+                                                                      end_date),
+                                gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+
+        with self._get_producer() as producer:
+            log.info('Publishing full feed...')
+            producer.publish(feed, routing_key=load_realtime.queue_name)
+            log.info('Full feed published.')
+
+    def listen_load_realtime(self, queue_name, retry_timeout=10, chunk_size=None, use_snapshot=False):
+        """
+        listen for load_realtime tasks and answer with the full feed of the requested contributors
+
+        if chunk_size is given, the feed is sent in several messages of at most chunk_size trip updates
+        if use_snapshot is True, the feed is made from the FeedEntitySnapshot instead of the TripUpdates
+        when it can be (see _publish_full_feed)
+        """
         log = logging.getLogger(__name__)
 
         def callback(body, message):
@@ -89,7 +359,8 @@ class RabbitMQHandler(object):
                     log.warn('invalid protobuf: {}'.format(str(e)))
                     return
 
-                log.info('getting a request: {}'.format(task))
+                log.info('getting a request')
+                log_payload('load_realtime request', task)
                 if task.action != task_pb2.LOAD_REALTIME or not task.load_realtime:
                     return
                 begin_date = None
@@ -101,15 +372,7 @@ class RabbitMQHandler(object):
                 if hasattr(task.load_realtime, "end_date"):
                     if task.load_realtime.end_date:
                         end_date = str_to_date(task.load_realtime.end_date)
-                feed = convert_to_gtfsrt(TripUpdate.find_by_contributor_period(task.load_realtime.contributors,
-                                                                               begin_date,
-                                                                               end_date),
-                                         gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
-
-                with self._get_producer() as producer:
-                    log.info('Publishing full feed...')
-                    producer.publish(feed.SerializeToString(), routing_key=task.load_realtime.queue_name)
-                    log.info('Full feed published.')
+                self._publish_full_feed(task.load_realtime, begin_date, end_date, chunk_size, use_snapshot)
             finally:
                 db.session.remove()
 
@@ -150,7 +413,8 @@ def monitor_heartbeats(connections, rate=2):
 
     def heartbeat_check():
         to_remove = []
-        for conn in connections:
+        # the connections can be added by other greenlets while the heartbeats are sent
+        for conn in list(connections):
             if conn.connected:
                 logging.getLogger(__name__).debug('heartbeat_check for %s', conn)
                 try:
@@ -162,7 +426,7 @@ def monitor_heartbeats(connections, rate=2):
             else:
                 to_remove.append(conn)
         for conn in to_remove:
-            connections.remove(conn)
+            connections.discard(conn)
         gevent.spawn_later(interval, heartbeat_check)
 
     gevent.spawn_later(interval, heartbeat_check)
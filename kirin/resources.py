@@ -26,11 +26,13 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
+import uuid
 from flask_restful import Resource, url_for
 import kirin
 from kirin.version import version
 from flask import current_app
 from kirin.core import model
+from kirin.exceptions import ObjectNotFound
 
 class Index(Resource):
     def get(self):
@@ -48,5 +50,31 @@ class Status(Resource):
                    'db_version': kirin.db.engine.scalar('select version_num from alembic_version;'),
                    'navitia_url': current_app.config['NAVITIA_URL'],
                    'rabbitmq_info': kirin.rabbitmq_handler.info(),
+                   'navitia_cache': kirin.navitia_vj_cache.info(),
+                   'feed_coalescer': kirin.feed_coalescer.info(),
+                   'priority_publisher': kirin.priority_publisher.info(),
                    'last_update': model.RealTimeUpdate.get_last_update_by_contributor(),
                }, 200
+
+
+class RealTimeUpdateStatus(Resource):
+    def get(self, id):
+        """
+        the status of the handling of a RealTimeUpdate, mainly for the ones received in asynchronous mode
+        """
+        try:
+            uuid.UUID(id)
+        except ValueError:
+            # it is not even a uuid, there is no need to query the db
+            raise ObjectNotFound('no real time update {}'.format(id))
+        rt_update = model.RealTimeUpdate.query.get(id)
+        if rt_update is None:
+            raise ObjectNotFound('no real time update {}'.format(id))
+        return {
+                   'id': rt_update.id,
+                   'connector': rt_update.connector,
+                   'status': rt_update.status,
+                   'error': rt_update.error,
+                   'received_at': rt_update.received_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   'nb_trip_updates': len(rt_update.trip_updates),
+               }, 200
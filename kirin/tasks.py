@@ -38,9 +38,10 @@ import requests
 from kirin import gtfs_realtime_pb2
 from kirin import core
 import navitia_wrapper
-from kirin.utils import make_rt_update
+from kirin.utils import make_rt_update, make_navitia_wrapper
 from kirin.exceptions import KirinException, InvalidArguments
 from kirin.gtfs_rt.model_maker import KirinModelBuilder
+from kirin.gtfs_rt import model_maker
 
 
 #we don't want celery to mess with our logging configuration
@@ -71,3 +72,58 @@ def poller(self):
               }
     gtfs_poller.delay(config)
 
+
+
+@celery.task(bind=True)
+def handle_real_time_update(self, rt_update_id):
+    """
+    handle a RealTimeUpdate received in asynchronous mode (see ASYNC_INGESTION)
+
+    the RealTimeUpdate is 'pending' until it has been handled, then it is 'OK' or 'KO'
+    """
+    logger = logging.getLogger(__name__)
+    rt_update = model.RealTimeUpdate.query.get(rt_update_id)
+    if rt_update is None or rt_update.status != 'pending':
+        logger.warning('real time update {} not found or not pending, it is not handled'.format(rt_update_id))
+        return
+
+    try:
+        if rt_update.connector == 'ire':
+            from kirin.ire import ire
+            nav = make_navitia_wrapper()
+            nav.timeout = app.config.get('NAVITIA_TIMEOUT', 5)
+            ire.handle(rt_update, nav, app.config['CONTRIBUTOR'])
+        else:
+            proto = gtfs_realtime_pb2.FeedMessage()
+            proto.ParseFromString(rt_update.raw_data)
+            nav = navitia_wrapper.Navitia(url=app.config['NAVITIA_URL'],
+                                          token=app.config.get('NAVITIA_GTFS_RT_TOKEN'))\
+                                 .instance(app.config['NAVITIA_GTFS_RT_INSTANCE'])
+            nav.timeout = app.config.get('NAVITIA_TIMEOUT', 5)
+            model_maker.handle_rt_update(rt_update, proto, nav, app.config['GTFS_RT_CONTRIBUTOR'])
+    except Exception as e:
+        if rt_update.status == 'pending':
+            # the data have been interpreted, but the handling failed later (for example on the publication)
+            model.db.session.rollback()
+            rt_update.status = 'KO'
+            rt_update.error = e.data.get('error', e.message) if isinstance(e, KirinException) else e.message
+            model.db.session.commit()
+        if isinstance(e, KirinException):
+            # the error is known and the RealTimeUpdate is flagged as KO, no need to make the task fail
+            logger.warning('real time update {} is KO: {}'.format(rt_update_id, rt_update.error))
+            return
+        raise
+
+    rt_update.status = 'OK'
+    model.db.session.commit()
+
+
+@celery.task(bind=True)
+def purge_rt_update(self):
+    """
+    purge the real_time_updates according to their retention (see RT_UPDATE_RETENTION)
+    """
+    nb_purged = model.RealTimeUpdate.apply_retention(app.config['RT_UPDATE_RETENTION'],
+                                                     app.config.get('RT_UPDATE_RETENTION_KEEP_METADATA'),
+                                                     app.config.get('RT_UPDATE_RETENTION_BATCH_SIZE', 1000))
+    logging.getLogger(__name__).info('%s real time updates purged', nb_purged)
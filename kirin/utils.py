@@ -27,9 +27,15 @@
 # www.navitia.io
 
 import logging
+import random
+import zlib
 from aniso8601 import parse_date
 from pythonjsonlogger import jsonlogger
 from flask.globals import current_app
+from sqlalchemy import inspect
+from flask import url_for
+from google.protobuf import text_format
+from google.protobuf.message import Message
 import navitia_wrapper
 
 from kirin.core import model
@@ -60,6 +66,78 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
         return log_record
 
 
+class _BoundedOutput(object):
+    """
+    file-like object keeping the first max_size characters written, Full is raised when they are reached
+    """
+    class Full(Exception):
+        pass
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, s):
+        room = self.max_size - self._size
+        if len(s) > room:
+            self._parts.append(s[:room])
+            raise self.Full()
+        self._parts.append(s)
+        self._size += len(s)
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+class TruncatedPayload(object):
+    """
+    string representation of a payload, truncated at max_size characters
+
+    the payload is formatted only when needed (ie when the log record is really emitted), and a protobuf
+    message is formatted field by field, only up to max_size characters
+
+    >>> str(TruncatedPayload('bobette', 3))
+    'bob... (truncated)'
+    >>> str(TruncatedPayload('bob', 3))
+    'bob'
+    """
+    def __init__(self, payload, max_size=None):
+        self.payload = payload
+        self.max_size = max_size
+
+    def __str__(self):
+        if not self.max_size:
+            return str(self.payload)
+        out = _BoundedOutput(self.max_size)
+        try:
+            if isinstance(self.payload, Message):
+                text_format.PrintMessage(self.payload, out)
+            else:
+                out.write(str(self.payload))
+        except _BoundedOutput.Full:
+            return '{}... (truncated)'.format(out.getvalue())
+        return out.getvalue()
+
+
+def log_payload(label, payload, contributor=None):
+    """
+    log a payload (a received feed, a task, ...) in the 'kirin.payload' logger at debug level
+
+    only a sample of the payloads can be logged, with a sampling rate by contributor
+    (PAYLOAD_LOG_SAMPLING, PAYLOAD_LOG_DEFAULT_SAMPLING), and they are truncated at PAYLOAD_LOG_MAX_SIZE
+    """
+    logger = logging.getLogger('kirin.payload')
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    config = current_app.config
+    rate = config.get('PAYLOAD_LOG_SAMPLING', {}).get(contributor, config.get('PAYLOAD_LOG_DEFAULT_SAMPLING', 1.))
+    if rate < 1 and random.random() >= rate:
+        return
+    logger.debug('%s: %s', label, TruncatedPayload(payload, config.get('PAYLOAD_LOG_MAX_SIZE')),
+                 extra={'contributor': contributor})
+
+
 def make_navitia_wrapper():
     """
     return a navitia wrapper to call the navitia API
@@ -70,12 +148,71 @@ def make_navitia_wrapper():
     return navitia_wrapper.Navitia(url=url, token=token).instance(instance)
 
 
-def make_rt_update(data, connector):
+def make_rt_update(data, connector, status=None):
     """
     Create an RealTimeUpdate object for the query and persist it
+
+    with SINGLE_TRANSACTION_INGESTION, it is only committed with the result of its handling
+    (but the pending ones are committed right away for the workers)
     """
-    rt_update = model.RealTimeUpdate(data, connector=connector)
+    rt_update = model.RealTimeUpdate(data, connector=connector, status=status)
 
     model.db.session.add(rt_update)
-    model.db.session.commit()
+    if status == 'pending' or not current_app.config.get('SINGLE_TRANSACTION_INGESTION'):
+        model.db.session.commit()
     return rt_update
+
+
+def save_rt_update_error(rt_update, error):
+    """
+    save the RealTimeUpdate as KO, when its handling failed
+
+    the session is rolled back first, so nothing of the failed handling is written but the RealTimeUpdate
+    """
+    model.db.session.rollback()
+    if inspect(rt_update).transient:
+        # it was only written in the rolled back transaction (SINGLE_TRANSACTION_INGESTION),
+        # it is written again alone
+        rt_update.trip_updates = []
+    rt_update.status = 'KO'
+    rt_update.error = error
+    model.db.session.add(rt_update)
+    model.db.session.commit()
+
+
+def lane_of(dispatch_key, nb_lanes):
+    """
+    the ingestion lane of a dispatch key, stable across processes
+
+    >>> lane_of('bob', 4) == lane_of('bob', 4)
+    True
+    >>> 0 <= lane_of('bob', 4) < 4
+    True
+    """
+    if isinstance(dispatch_key, unicode):
+        dispatch_key = dispatch_key.encode('utf-8')
+    return (zlib.crc32(dispatch_key) & 0xffffffff) % nb_lanes
+
+
+def delay_rt_update(data, connector, dispatch_key=None):
+    """
+    Persist the RealTimeUpdate as pending and let a celery worker handle it
+
+    if ASYNC_INGESTION_LANES is set, the task is sent to the queue of the lane of the dispatch key,
+    so the RealTimeUpdates with the same dispatch key (ie the same trips) are handled in order
+
+    return the response for the query: 202 with the id of the RealTimeUpdate to follow its handling
+    """
+    from kirin.tasks import handle_real_time_update
+    rt_update = make_rt_update(data, connector, status='pending')
+    nb_lanes = current_app.config.get('ASYNC_INGESTION_LANES')
+    if nb_lanes and dispatch_key is not None:
+        queue = '{}{}'.format(current_app.config['ASYNC_INGESTION_LANE_QUEUE_PREFIX'], lane_of(dispatch_key, nb_lanes))
+        handle_real_time_update.apply_async(args=[rt_update.id], queue=queue)
+    else:
+        handle_real_time_update.delay(rt_update.id)
+    return {
+        'id': rt_update.id,
+        'status': rt_update.status,
+        'href': url_for('real_time_update', id=rt_update.id, _external=True),
+    }, 202
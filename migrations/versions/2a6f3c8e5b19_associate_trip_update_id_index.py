@@ -0,0 +1,27 @@
+"""add an index on trip_update_id for associate_realtimeupdate_tripupdate
+
+the primary key (real_time_update_id, trip_update_id) cannot be used to find the rows of a trip_update
+(loading of the real_time_updates of a trip_update, purge)
+
+Revision ID: 2a6f3c8e5b19
+Revises: 4e2b7a9c1d36
+Create Date: 2017-10-02 14:27:03.618452
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2a6f3c8e5b19'
+down_revision = '4e2b7a9c1d36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('associate_realtimeupdate_tripupdate_trip_update_id_idx', 'associate_realtimeupdate_tripupdate',
+                    ['trip_update_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('associate_realtimeupdate_tripupdate_trip_update_id_idx',
+                  table_name='associate_realtimeupdate_tripupdate')
@@ -0,0 +1,22 @@
+"""add a fingerprint on trip_update to detect the updates without changes
+
+Revision ID: 3d8a1f2b7c40
+Revises: 4bc4b1e8f681
+Create Date: 2017-09-20 10:12:41.305817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d8a1f2b7c40'
+down_revision = '4bc4b1e8f681'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('trip_update', sa.Column('fingerprint', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('trip_update', 'fingerprint')
@@ -0,0 +1,35 @@
+"""add the feed_entity_snapshot table, the encoded gtfs-rt entity of each trip_update
+
+Revision ID: 4e2b7a9c1d36
+Revises: 58c1a5e9d3b2
+Create Date: 2017-09-27 10:12:45.581204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e2b7a9c1d36'
+down_revision = '58c1a5e9d3b2'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('feed_entity_snapshot',
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('vj_id', postgresql.UUID(), nullable=False),
+    sa.Column('contributor', sa.Text(), nullable=False),
+    sa.Column('circulation_date', sa.Date(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['vj_id'], [u'trip_update.vj_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('vj_id')
+    )
+    op.create_index('feed_entity_snapshot_contributor_circulation_date_idx', 'feed_entity_snapshot',
+                    ['contributor', 'circulation_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('feed_entity_snapshot_contributor_circulation_date_idx', table_name='feed_entity_snapshot')
+    op.drop_table('feed_entity_snapshot')
@@ -0,0 +1,55 @@
+"""store the raw_data of real_time_update as binary, with a codec
+
+Revision ID: 58c1a5e9d3b2
+Revises: 3d8a1f2b7c40
+Create Date: 2017-09-22 15:41:09.120394
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '58c1a5e9d3b2'
+down_revision = '3d8a1f2b7c40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    """
+    the old raw_data are kept in the text column, they can be moved in the binary column afterward
+    with the 'compress_raw_data' command
+    """
+    op.add_column('real_time_update', sa.Column('raw_data_bin', sa.LargeBinary(), nullable=True))
+    op.add_column('real_time_update', sa.Column('raw_data_codec', sa.Text(), nullable=True))
+
+
+def downgrade():
+    """
+    the raw_data are moved back in the text column, in their previous form: the compressed ones and the gtfs-rt
+    feeds (their protobuf wire format is binary, they were stored in the protobuf text format) are converted
+    in python by batches, the other ones directly in sql
+    """
+    from kirin.core import codec
+    from kirin import gtfs_realtime_pb2
+    connection = op.get_bind()
+    update = sa.text("UPDATE real_time_update SET raw_data = :data WHERE id = :id")
+    while True:
+        rows = connection.execute(sa.text("SELECT id, connector, raw_data_bin, raw_data_codec FROM real_time_update "
+                                          "WHERE raw_data IS NULL AND raw_data_bin IS NOT NULL "
+                                          "AND (raw_data_codec != 'raw' OR connector = 'gtfs-rt') "
+                                          "LIMIT 1000")).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            # an unknown codec raises an error, the downgrade is not done rather than losing some raw_data
+            data = codec.decode(str(row['raw_data_bin']), row['raw_data_codec'])
+            if row['connector'] == 'gtfs-rt':
+                feed = gtfs_realtime_pb2.FeedMessage()
+                feed.ParseFromString(data)
+                data = str(feed)
+            connection.execute(update, data=data.decode('utf-8'), id=row['id'])
+
+    op.execute("""UPDATE real_time_update SET raw_data = convert_from(raw_data_bin, 'UTF8') \
+               WHERE raw_data IS NULL AND raw_data_codec = 'raw';""")
+    op.drop_column('real_time_update', 'raw_data_codec')
+    op.drop_column('real_time_update', 'raw_data_bin')
@@ -0,0 +1,28 @@
+"""add the publication_outbox table, the feeds waiting to be published in rabbitmq
+
+Revision ID: 5b8e1d4f7a23
+Revises: 2a6f3c8e5b19
+Create Date: 2017-10-05 16:03:51.274330
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1d4f7a23'
+down_revision = '2a6f3c8e5b19'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('publication_outbox',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('contributor', sa.Text(), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('publication_outbox')
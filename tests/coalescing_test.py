@@ -0,0 +1,103 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from kirin.core.coalescing import CoalescingPublisher
+from kirin.core.populate_pb import _FEED_ENTITY_KEY, _varint
+from kirin import gtfs_realtime_pb2
+import gevent
+
+
+def encoded_entity(trip_id, start_date):
+    entity = gtfs_realtime_pb2.FeedEntity()
+    entity.id = trip_id
+    entity.trip_update.trip.trip_id = trip_id
+    entity.trip_update.trip.start_date = start_date
+    data = entity.SerializeToString()
+    return _FEED_ENTITY_KEY + _varint(len(data)) + data
+
+
+def test_coalescing():
+    """
+    the trips added during the window are published in one feed, with only their latest state
+    """
+    published = []
+    coalescer = CoalescingPublisher(0.01, publish=lambda feed, contributor: published.append((contributor, feed)))
+
+    coalescer.add_entities('bob', [('vj:1', encoded_entity('vj:1', '20150921')),
+                                   ('vj:2', encoded_entity('vj:2', '20150921'))])
+    coalescer.add_entities('bob', [('vj:1', encoded_entity('vj:1', '20150922'))])
+    coalescer.add_entities('bobette', [('vj:3', encoded_entity('vj:3', '20150921'))])
+    assert coalescer.info()['buffered_trips'] == {'bob': 2, 'bobette': 1}
+    assert published == []
+
+    gevent.sleep(0.05)
+
+    assert sorted(c for c, _ in published) == ['bob', 'bobette']
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(dict(published)['bob'])
+    assert feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    assert [(e.id, e.trip_update.trip.start_date) for e in feed.entity] == [('vj:2', '20150921'),
+                                                                            ('vj:1', '20150922')]
+    info = coalescer.info()
+    assert info['buffered_trips'] == {}
+    assert info['published_feeds'] == 2
+    assert info['coalesced_trips'] == 1
+
+
+def test_coalescing_max_size():
+    published = []
+    coalescer = CoalescingPublisher(60, max_size=2, publish=lambda feed, contributor: published.append(contributor))
+
+    coalescer.add_entities('bob', [('vj:1', encoded_entity('vj:1', '20150921'))])
+    coalescer.add_entities('bob', [('vj:2', encoded_entity('vj:2', '20150921'))])
+    gevent.sleep(0)
+
+    assert published == ['bob']
+
+
+def test_coalescing_max_size_next_window():
+    """
+    after a flush on max_size, the next buffer is published at the end of its own window
+    """
+    published = []
+    coalescer = CoalescingPublisher(0.1, max_size=2, publish=lambda feed, contributor: published.append(contributor))
+
+    coalescer.add_entities('bob', [('vj:1', encoded_entity('vj:1', '20150921')),
+                                   ('vj:2', encoded_entity('vj:2', '20150921'))])
+    gevent.sleep(0.05)
+    assert published == ['bob']
+
+    coalescer.add_entities('bob', [('vj:3', encoded_entity('vj:3', '20150921'))])
+    # the window of the first buffer is over, not the one of the second
+    gevent.sleep(0.07)
+    assert published == ['bob']
+    assert coalescer.info()['buffered_trips'] == {'bob': 1}
+
+    gevent.sleep(0.1)
+    assert published == ['bob', 'bob']
@@ -33,7 +33,7 @@ import logging
 from retrying import retry
 
 # postgres image
-POSTGRES_IMAGE = 'postgres:9.4'
+POSTGRES_IMAGE = 'postgres:9.6'
 POSTGRES_CONTAINER_NAME = 'kirin_test_postgres'
 
 
@@ -41,7 +41,7 @@ def _get_docker_file():
     """
     Return a dumb DockerFile
     
-    The best way to get the image would be to get postgres:9.4 it from dockerhub,
+    The best way to get the image would be to get postgres:9.6 it from dockerhub,
     but with this dumb wrapper the runtime time of the unit tests
     is reduced by 10s
     """
@@ -27,8 +27,10 @@
 # www.navitia.io
 from datetime import timedelta
 import datetime
+import gevent
 import pytest
-from kirin.core.model import RealTimeUpdate, db, TripUpdate, StopTimeUpdate
+from kirin.core.model import RealTimeUpdate, db, TripUpdate, StopTimeUpdate, VehicleJourney
+from kirin.core.handler import handle
 from kirin.core.populate_pb import to_posix_time
 from kirin.gtfs_rt import gtfs_rt
 from tests import mock_navitia
@@ -143,6 +145,85 @@ def test_gtfs_model_builder(basic_gtfs_rt_data):
         assert fourth_stop.message is None
 
 
+def test_gtfs_model_builder_concurrent_lookups(monkeypatch):
+    """
+    the vjs are searched concurrently in navitia, the trip updates are still built in the feed order,
+    a vj not found does not prevent the other trips from being handled, but a navitia error fails the feed
+    """
+    monkeypatch.setitem(app.config, 'GTFS_RT_NAVITIA_CONCURRENCY', 3)
+    monkeypatch.setattr('kirin.gtfs_rt.model_maker._navitia_pools', {})
+    # the first searches are the slowest
+    durations = {'trip:1': 0.03, 'trip:2': 0.02, 'trip:3': 0.01, 'trip:4': 0}
+    not_found = {'trip:2'}
+    errors = set()
+
+    def get_navitia_vjs(self, trip, data_time):
+        gevent.sleep(durations[trip.trip_id])
+        if trip.trip_id in errors:
+            raise Exception('navitia is down')
+        if trip.trip_id in not_found:
+            return []
+        return [VehicleJourney({'id': trip.trip_id, 'trip': {'id': trip.trip_id}}, data_time.date())]
+    monkeypatch.setattr(gtfs_rt.KirinModelBuilder, '_get_navitia_vjs', get_navitia_vjs)
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = to_posix_time(datetime.datetime(year=2012, month=6, day=15, hour=15))
+    for trip_id in sorted(durations):
+        entity = feed.entity.add()
+        entity.id = trip_id
+        entity.trip_update.trip.trip_id = trip_id
+
+    with app.app_context():
+        rt_update = RealTimeUpdate(None, connector='gtfs-rt')
+        trip_updates = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper(), 'kisio-digital').build(rt_update, feed)
+
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['trip:1', 'trip:3', 'trip:4']
+
+        errors.add('trip:3')
+        with pytest.raises(Exception):
+            gtfs_rt.KirinModelBuilder(dumb_nav_wrapper(), 'kisio-digital').build(rt_update, feed)
+
+
+def test_gtfs_model_builder_loop(mock_rabbitmq):
+    """
+    the vj serves StopA twice, the delay given on its second passage (after StopB) must be applied
+    to the second stop_time only, even if there is no update on the first passage
+    """
+    def stop_time(stop, hour):
+        return {'arrival_time': datetime.time(hour), 'departure_time': datetime.time(hour),
+                'stop_point': {'id': stop, 'codes': [{'type': 'source', 'value': 'Code-' + stop}],
+                               'stop_area': {'timezone': 'UTC'}}}
+    navitia_vj = {'id': 'vj:loop', 'trip': {'id': 'vj:loop'},
+                  'stop_times': [stop_time('StopA', 8), stop_time('StopB', 9), stop_time('StopA', 10)]}
+
+    input_trip_update = gtfs_realtime_pb2.TripUpdate()
+    input_trip_update.trip.trip_id = 'Code-vj-loop'
+    stu = input_trip_update.stop_time_update.add()
+    stu.stop_sequence = 2
+    stu.stop_id = 'Code-StopB'
+    stu = input_trip_update.stop_time_update.add()
+    stu.arrival.delay = 120
+    stu.stop_sequence = 3
+    stu.stop_id = 'Code-StopA'
+
+    with app.app_context():
+        vj = VehicleJourney(navitia_vj, datetime.date(2012, 6, 15))
+        trip_updates = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper())._make_trip_updates(input_trip_update, [vj])
+        assert len(trip_updates) == 1
+        assert [st.vj_position for st in trip_updates[0].stop_time_updates] == [1, 2]
+
+        rt_update = handle(RealTimeUpdate(None, connector='gtfs-rt'), trip_updates, 'kisio-digital')
+        stop_time_updates = rt_update.trip_updates[0].stop_time_updates
+        assert [st.stop_id for st in stop_time_updates] == ['StopA', 'StopB', 'StopA']
+        assert stop_time_updates[0].arrival_status == 'none'
+        assert stop_time_updates[0].arrival == datetime.datetime(2012, 6, 15, 8)
+        assert stop_time_updates[1].arrival_status == 'none'
+        assert stop_time_updates[2].arrival_status == 'update'
+        assert stop_time_updates[2].arrival_delay == timedelta(minutes=2)
+        assert stop_time_updates[2].arrival == datetime.datetime(2012, 6, 15, 10, 2)
+
+
 def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
     """
     test the gtfs-rt post with a simple gtfs-rt
@@ -210,3 +291,47 @@ def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
         assert fourth_stop.departure_status == 'none'
         assert fourth_stop.departure == datetime.datetime(2012, 6, 15, 15, 33)
         assert fourth_stop.message is None
+
+
+class MockResponse(object):
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+
+def test_gtfs_poller_unchanged_feed(basic_gtfs_rt_data, monkeypatch):
+    """
+    the same feed polled twice is handled only once, and the http validators are sent back
+    """
+    from mock import MagicMock
+    from kirin.gtfs_rt import tasks
+    monkeypatch.setattr(tasks, '_last_feeds', {})
+    mock_handle = MagicMock()
+    monkeypatch.setattr('kirin.gtfs_rt.model_maker.handle', mock_handle)
+    mock_get = MagicMock(return_value=MockResponse(basic_gtfs_rt_data.SerializeToString(),
+                                                   headers={'ETag': '"42"'}))
+    monkeypatch.setattr('requests.get', mock_get)
+    config = {'contributor': 'realtime.sherbrooke', 'navitia_url': '', 'token': None, 'coverage': '',
+              'feed_url': 'http://bob/feed'}
+
+    tasks.gtfs_poller(config)
+    assert mock_handle.call_count == 1
+
+    tasks.gtfs_poller(config)
+    assert mock_handle.call_count == 1
+    assert mock_get.call_args[1]['headers'] == {'If-None-Match': '"42"'}
+
+    # the server says the feed has not been modified
+    mock_get.return_value = MockResponse('', status_code=304)
+    tasks.gtfs_poller(config)
+    assert mock_handle.call_count == 1
+
+    # a new feed is handled
+    basic_gtfs_rt_data.header.timestamp += 60
+    mock_get.return_value = MockResponse(basic_gtfs_rt_data.SerializeToString())
+    tasks.gtfs_poller(config)
+    assert mock_handle.call_count == 2
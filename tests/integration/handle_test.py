@@ -29,9 +29,13 @@
 from datetime import timedelta
 
 import pytest
-from kirin.core.handler import handle
-from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
+from kirin.core.handler import handle, get_base_schedule
+from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate, FeedEntitySnapshot
+from kirin.core.populate_pb import assemble_gtfsrt, convert_to_gtfsrt, serialize_gtfsrt, encode_entity
+from kirin.command.build_feed_snapshot import build_feed_snapshot
+from kirin import gtfs_realtime_pb2, task_pb2
 import datetime
+import kirin
 from kirin import app, db
 from tests.check_utils import _dt
 
@@ -157,6 +161,25 @@ def test_handle_new_vj():
         assert db_st_updates[1].trip_update_id == db_trip_updates[0].vj_id
 
 
+def test_base_schedule():
+    """
+    the base schedule is computed in UTC with the past-midnight, and only once per circulation date
+    """
+    navitia_vj = {'trip': {'id': 'vehicle_journey:1'}, 'stop_times': [
+        {'arrival_time': None, 'departure_time': datetime.time(23, 10),
+         'stop_point': {'id': 'sa:1', 'stop_area': {'timezone': 'Europe/Paris'}}},
+        {'arrival_time': datetime.time(0, 15), 'departure_time': None,
+         'stop_point': {'id': 'sa:2', 'stop_area': {'timezone': 'Europe/Paris'}}}
+    ]}
+    base_schedule = get_base_schedule(navitia_vj, datetime.date(2015, 9, 8))
+    assert base_schedule == [(None, datetime.datetime(2015, 9, 8, 21, 10)),
+                             (datetime.datetime(2015, 9, 8, 22, 15), None)]
+
+    assert get_base_schedule(navitia_vj, datetime.date(2015, 9, 8)) is base_schedule
+    assert get_base_schedule(navitia_vj, datetime.date(2015, 9, 9))[0] == \
+        (None, datetime.datetime(2015, 9, 9, 21, 10))
+
+
 def test_past_midnight():
     """
     integration of a past midnight
@@ -352,6 +375,222 @@ def test_handle_update_vj(setup_database, navitia_vj):
         assert db_stu_map['sa:3'].departure == _dt("10:05")
 
 
+def test_handle_update_vj_bulk_persistence(setup_database, navitia_vj, monkeypatch):
+    """
+    same as test_handle_update_vj, but the StopTimeUpdates are written in bulk
+    """
+    monkeypatch.setitem(app.config, 'BULK_PERSISTENCE', True)
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        st = StopTimeUpdate({'id': 'sa:2'},
+                            arrival_delay=timedelta(minutes=10), dep_status='update',
+                            departure_delay=timedelta(minutes=10), arr_status='update')
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire')
+        trip_update.stop_time_updates.append(st)
+        res = handle(real_time_update, [trip_update], 'kisio-digital')
+
+        assert len(res.trip_updates) == 1
+        trip_update = res.trip_updates[0]
+        assert len(trip_update.real_time_updates) == 2
+        assert [stu.stop_id for stu in trip_update.stop_time_updates] == ['sa:1', 'sa:2', 'sa:3']
+        assert trip_update.stop_time_updates[0].departure == _dt("8:15")
+        assert trip_update.stop_time_updates[1].arrival == _dt("9:15")
+        assert trip_update.stop_time_updates[1].departure == _dt("9:20")
+        assert trip_update.stop_time_updates[1].departure_status == 'update'
+        assert trip_update.stop_time_updates[2].arrival == _dt("10:05")
+        assert len(StopTimeUpdate.query.all()) == 6
+
+        # a new trip is written in bulk too
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 9)), status='update')
+        st = StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update')
+        trip_update.stop_time_updates.append(st)
+        handle(RealTimeUpdate(raw_data=None, connector='ire'), [trip_update], 'kisio-digital')
+
+        db_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 9))
+        assert len(db_trip_update.stop_time_updates) == 3
+        assert db_trip_update.stop_time_updates[0].departure == _dt("8:15", day=9)
+        assert db_trip_update.stop_time_updates[0].created_at is not None
+        assert len(StopTimeUpdate.query.all()) == 9
+
+
+def test_handle_update_vj_snapshot(setup_database, navitia_vj, monkeypatch):
+    """
+    the snapshot holds the encoded entity of the latest state of the updated trip
+    """
+    monkeypatch.setitem(app.config, 'GTFSRT_SNAPSHOT', True)
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        st = StopTimeUpdate({'id': 'sa:2'},
+                            arrival_delay=timedelta(minutes=10), dep_status='update',
+                            departure_delay=timedelta(minutes=10), arr_status='update')
+        trip_update.stop_time_updates.append(st)
+        handle(RealTimeUpdate(raw_data=None, connector='ire'), [trip_update], 'kisio-digital')
+
+        snapshot = FeedEntitySnapshot.find_data_by_contributor_period(['kisio-digital'])
+        assert len(snapshot) == 1
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(assemble_gtfsrt(snapshot))
+        db_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        assert feed.entity[0] == convert_to_gtfsrt([db_trip_update]).entity[0]
+
+        assert FeedEntitySnapshot.find_data_by_contributor_period(['kisio-digital'],
+                                                                  start_date=datetime.date(2015, 9, 9)) == []
+
+
+def test_handle_rejected_update_fingerprint(navitia_vj, monkeypatch):
+    """
+    a trip update changed by the merge is written with its new fingerprint even if the update is rejected,
+    so the encoded entity cached for its previous state is not used anymore
+    """
+    def make_trip_update(delay):
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=delay),
+                                                            arr_status='update'))
+        return trip_update
+
+    with app.app_context():
+        handle(RealTimeUpdate(raw_data=None, connector='ire'), [make_trip_update(5)], 'kisio-digital')
+        db_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        encode_entity(db_trip_update)
+
+        monkeypatch.setattr('kirin.core.handler.manage_consistency', lambda trip_update: False)
+        handle(RealTimeUpdate(raw_data=None, connector='ire'), [make_trip_update(10)], 'kisio-digital')
+        db.session.remove()
+
+        db_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        assert db_trip_update.stop_time_updates[1].arrival_delay == timedelta(minutes=10)
+        assert db_trip_update.fingerprint == db_trip_update.compute_fingerprint()
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(assemble_gtfsrt([encode_entity(db_trip_update)]))
+        assert feed.entity[0] == convert_to_gtfsrt([db_trip_update]).entity[0]
+
+
+class ProducerMock(object):
+    """
+    producer recording the published messages, returned by RabbitMQHandler._get_producer
+    """
+    def __init__(self):
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def publish(self, body, routing_key, headers=None):
+        self.messages.append((body, headers))
+
+
+def _merge_feeds(messages):
+    """
+    FeedMessage with the header of the first feed and the entities of all the feeds sorted by id
+
+    the timestamp is removed to compare feeds built at different times
+    """
+    res = gtfs_realtime_pb2.FeedMessage()
+    entities = []
+    for sequence, body in enumerate(messages):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(body)
+        if sequence == 0:
+            res.header.CopyFrom(feed.header)
+        entities.extend(feed.entity)
+    res.header.ClearField('timestamp')
+    for entity in sorted(entities, key=lambda e: e.id):
+        res.entity.add().CopyFrom(entity)
+    return res
+
+
+def test_full_feed_by_chunks_and_from_snapshot(navitia_vj, monkeypatch):
+    """
+    the full feed published by chunks or made from the snapshot gives the same FeedMessage
+    as the full feed published in one message
+    """
+    monkeypatch.setitem(app.config, 'GTFSRT_SNAPSHOT', True)
+    with app.app_context():
+        for day in (7, 8, 9):
+            trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, day)), status='update')
+            st = StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=day), arr_status='update')
+            trip_update.stop_time_updates.append(st)
+            handle(RealTimeUpdate(raw_data=None, connector='ire'), [trip_update], 'kisio-digital')
+
+        task = task_pb2.Task()
+        task.load_realtime.contributors.append('kisio-digital')
+        task.load_realtime.queue_name = 'kirin_test'
+        full_feed = _merge_feeds([serialize_gtfsrt(TripUpdate.find_by_contributor_period(['kisio-digital']),
+                                                   gtfs_realtime_pb2.FeedHeader.FULL_DATASET)])
+        assert len(full_feed.entity) == 3
+        assert full_feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+
+        producer = ProducerMock()
+        monkeypatch.setattr(kirin.rabbitmq_handler, '_get_producer', lambda: producer)
+        kirin.rabbitmq_handler._publish_full_feed_by_chunks(task.load_realtime, None, None, chunk_size=2)
+        assert [headers for _, headers in producer.messages] == [{'sequence': 0, 'total': 2},
+                                                                  {'sequence': 1, 'total': 2}]
+        assert _merge_feeds([body for body, _ in producer.messages]) == full_feed
+
+        for chunk_size, nb_messages in [(None, 1), (2, 2)]:
+            producer = ProducerMock()
+            monkeypatch.setattr(kirin.rabbitmq_handler, '_get_producer', lambda: producer)
+            kirin.rabbitmq_handler._publish_full_feed_from_snapshot(task.load_realtime, None, None, chunk_size)
+            assert len(producer.messages) == nb_messages
+            assert _merge_feeds([body for body, _ in producer.messages]) == full_feed
+
+
+def test_full_feed_snapshot_fallback(navitia_vj, monkeypatch):
+    """
+    the full feed is made from the TripUpdates when a date range is asked for
+    or when the snapshot has not been built yet
+    """
+    with app.app_context():
+        # the trip updates are handled without GTFSRT_SNAPSHOT, so they are not in the snapshot
+        for day in (7, 8):
+            trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, day)), status='update')
+            st = StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=day), arr_status='update')
+            trip_update.stop_time_updates.append(st)
+            handle(RealTimeUpdate(raw_data=None, connector='ire'), [trip_update], 'kisio-digital')
+
+        task = task_pb2.Task()
+        task.load_realtime.contributors.append('kisio-digital')
+        task.load_realtime.queue_name = 'kirin_test'
+        from_snapshot = []
+        publish_from_snapshot = kirin.rabbitmq_handler._publish_full_feed_from_snapshot
+
+        def publish_full_feed_from_snapshot(*args, **kwargs):
+            from_snapshot.append(args)
+            publish_from_snapshot(*args, **kwargs)
+
+        monkeypatch.setattr(kirin.rabbitmq_handler, '_publish_full_feed_from_snapshot',
+                            publish_full_feed_from_snapshot)
+
+        def publish_full_feed(begin_date=None, end_date=None):
+            producer = ProducerMock()
+            monkeypatch.setattr(kirin.rabbitmq_handler, '_get_producer', lambda: producer)
+            kirin.rabbitmq_handler._publish_full_feed(task.load_realtime, begin_date, end_date, use_snapshot=True)
+            return _merge_feeds([body for body, _ in producer.messages])
+
+        assert not FeedEntitySnapshot.is_complete(['kisio-digital'])
+        assert len(publish_full_feed().entity) == 2
+        assert not from_snapshot
+
+        build_feed_snapshot()
+        assert FeedEntitySnapshot.is_complete(['kisio-digital'])
+        assert len(publish_full_feed().entity) == 2
+        assert len(from_snapshot) == 1
+
+        assert len(publish_full_feed(begin_date=datetime.date(2015, 9, 8)).entity) == 1
+        assert len(from_snapshot) == 1
+
+        # a snapshot missing one of the trip updates is not used either
+        FeedEntitySnapshot.query.filter(FeedEntitySnapshot.circulation_date == datetime.date(2015, 9, 8))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        assert not FeedEntitySnapshot.is_complete(['kisio-digital'])
+        assert len(publish_full_feed().entity) == 2
+        assert len(from_snapshot) == 1
+
+
 def test_simple_delay(navitia_vj):
     """Test on delay when there is nothing in the db"""
     with app.app_context():
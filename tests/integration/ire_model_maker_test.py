@@ -27,6 +27,8 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 from datetime import timedelta
+import datetime
+import xml.etree.cElementTree as ElementTree
 import pytest
 
 from kirin import db, app
@@ -120,3 +122,38 @@ def test_train_trip_removal(mock_navitia_fixture):
         assert trip_up.status == 'delete'
         # full trip removal : no stop_time to precise
         assert len(trip_up.stop_time_updates) == 0
+
+
+def test_stop_served_twice():
+    """
+    the stop_times of a stop served twice by the vj (lollipop line) are taken in the order of the IRE points
+    """
+    def make_stop_time(stop_point_id, code):
+        return {'stop_point': {'id': stop_point_id,
+                               'stop_area': {'codes': [{'type': 'CR-CI-CH', 'value': code}]}}}
+
+    def make_point(cr, ci, ch, delay):
+        return '<PointAval><CRPR>{}</CRPR><CIPR>{}</CIPR><CHPR>{}</CHPR>' \
+               '<IndicateurPRGare>true</IndicateurPRGare>' \
+               '<TypeHoraire><Depart><Etat>retard</Etat><EcartExterne>{}</EcartExterne></Depart></TypeHoraire>' \
+               '</PointAval>'.format(cr, ci, ch, delay)
+
+    navitia_vj = {'trip': {'id': 'trip:1'},
+                  'stop_times': [make_stop_time('sp:A', '0087-1-BV'),
+                                 make_stop_time('sp:B', '0087-2-BV'),
+                                 make_stop_time('sp:A', '0087-1-BV'),
+                                 make_stop_time('sp:C', '0087-3-BV')]}
+    xml_modification = ElementTree.fromstring('<TypeModification><HoraireProjete>{}{}{}</HoraireProjete>'
+                                              '</TypeModification>'
+                                              .format(make_point('0087', '1', 'BV', '00:05'),
+                                                      make_point('0087', '2', 'BV', '00:07'),
+                                                      make_point('0087', '1', 'BV', '00:10')))
+
+    with app.app_context():
+        vj = model.VehicleJourney(navitia_vj, datetime.date(2015, 9, 21))
+        trip_update = KirinModelBuilder(dumb_nav_wrapper())._make_trip_update(vj, xml_modification)
+
+        assert [(st.stop_id, st.vj_position, st.departure_delay) for st in trip_update.stop_time_updates] == \
+            [('sp:A', 0, timedelta(minutes=5)),
+             ('sp:B', 1, timedelta(minutes=7)),
+             ('sp:A', 2, timedelta(minutes=10))]
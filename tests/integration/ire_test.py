@@ -31,11 +31,13 @@ from datetime import timedelta
 
 import pytest
 
-from tests.check_utils import api_post
+from tests.check_utils import api_post, api_get
 import datetime
-from kirin import app
+from kirin import app, db
 from tests import mock_navitia
-from tests.check_utils import get_ire_data
+from tests.check_utils import get_ire_data, dumb_nav_wrapper
+from kirin.ire import ire
+from kirin.utils import make_rt_update
 from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate
 
 
@@ -382,6 +384,33 @@ def test_ire_delayed_post_twice(mock_rabbitmq):
     assert mock_rabbitmq.call_count == 2
 
 
+def test_ire_delayed_post_twice_only_changes(mock_rabbitmq, monkeypatch):
+    """
+    double delayed stops post, the second one does not change anything so it is not published
+    """
+    monkeypatch.setitem(app.config, 'PUBLISH_ONLY_CHANGED_TRIP_UPDATES', True)
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    res = api_post('/ire', data=ire_96231)
+    assert res == 'OK'
+    res = api_post('/ire', data=ire_96231)
+    assert res == 'OK'
+
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 2
+        assert len(TripUpdate.query.all()) == 1
+        assert len(TripUpdate.query.first().real_time_updates) == 1
+        assert len(StopTimeUpdate.query.all()) == 6
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+
+    # a different update is still published
+    ire_96231_trip_removal = get_ire_data('train_96231_trip_removal.xml')
+    res = api_post('/ire', data=ire_96231_trip_removal)
+    assert res == 'OK'
+    check_db_ire_96231_trip_removal()
+    assert mock_rabbitmq.call_count == 2
+
+
 def test_ire_trip_delayed_then_removal(mock_rabbitmq):
     """
     post delayed stops then trip removal on the same trip
@@ -502,6 +531,125 @@ def test_save_bad_raw_ire():
         assert RealTimeUpdate.query.first().raw_data == bad_ire
 
 
+def test_ire_post_single_transaction(mock_rabbitmq, monkeypatch):
+    """
+    the ire and its handling are saved in one transaction, and a bad ire is still saved as KO
+    """
+    monkeypatch.setitem(app.config, 'SINGLE_TRANSACTION_INGESTION', True)
+    monkeypatch.setitem(app.config, 'ASYNCHRONOUS_COMMIT_CONNECTORS', ['ire'])
+    res = api_post('/ire', data=get_ire_data('train_96231_delayed.xml'))
+    assert res == 'OK'
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+
+    bad_ire = get_ire_data('bad_ire.xml')
+    res, status = api_post('/ire', data=bad_ire, check=False)
+    assert status == 400
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 2
+        bad_rt_update = RealTimeUpdate.query.filter_by(status='KO').one()
+        assert bad_rt_update.raw_data == bad_ire
+
+
+def test_ire_post_single_transaction_handling_error(mock_rabbitmq, monkeypatch):
+    """
+    in one transaction, a failure after the model maker (here in the persistence) still saves the ire as KO
+    """
+    def failing_persist(real_time_update, outbox_contributor=None):
+        db.session.flush()
+        raise Exception('persistence error')
+    monkeypatch.setitem(app.config, 'SINGLE_TRANSACTION_INGESTION', True)
+    monkeypatch.setattr('kirin.core.handler.persist', failing_persist)
+
+    ire_data = get_ire_data('train_96231_delayed.xml')
+    with app.app_context():
+        with pytest.raises(Exception):
+            ire.handle(make_rt_update(ire_data, 'ire'), dumb_nav_wrapper(), app.config['CONTRIBUTOR'])
+
+        rt_update = RealTimeUpdate.query.one()
+        assert rt_update.status == 'KO'
+        assert rt_update.error == 'persistence error'
+        assert rt_update.raw_data == ire_data
+        assert len(TripUpdate.query.all()) == 0
+        assert len(StopTimeUpdate.query.all()) == 0
+    assert mock_rabbitmq.call_count == 0
+
+
+def test_ire_post_outbox(mock_rabbitmq, monkeypatch):
+    """
+    with the outbox, the feed is saved with the trip updates and published later by the relay
+    """
+    from kirin.core.handler import publish_outbox
+    from kirin.core.model import OutboxMessage
+    monkeypatch.setitem(app.config, 'PUBLICATION_OUTBOX', True)
+    res = api_post('/ire', data=get_ire_data('train_96231_delayed.xml'))
+    assert res == 'OK'
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 0
+
+    with app.app_context():
+        assert len(OutboxMessage.query.all()) == 1
+        assert publish_outbox() == 1
+        assert len(OutboxMessage.query.all()) == 0
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_ire_async_post(mock_rabbitmq, monkeypatch):
+    """
+    in asynchronous mode the ire is only saved, and handled later by a worker
+    """
+    from kirin.tasks import handle_real_time_update
+    delayed = []
+    monkeypatch.setitem(app.config, 'ASYNC_INGESTION', True)
+    monkeypatch.setattr(handle_real_time_update, 'delay', lambda rt_update_id: delayed.append(rt_update_id))
+
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    res, status = api_post('/ire', data=ire_96231, check=False)
+    assert status == 202
+    assert res['status'] == 'pending'
+    assert delayed == [res['id']]
+    with app.app_context():
+        assert len(TripUpdate.query.all()) == 0
+    assert mock_rabbitmq.call_count == 0
+    assert api_get('/real_time_updates/{}'.format(res['id']))['status'] == 'pending'
+
+    # the worker handles the ire
+    handle_real_time_update(res['id'])
+
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+    rt_update_status = api_get('/real_time_updates/{}'.format(res['id']))
+    assert rt_update_status['status'] == 'OK'
+    assert rt_update_status['nb_trip_updates'] == 1
+
+
+def test_ire_async_post_bad_ire(monkeypatch):
+    """
+    in asynchronous mode a bad ire is flagged KO by the worker
+    """
+    from kirin.tasks import handle_real_time_update
+    monkeypatch.setitem(app.config, 'ASYNC_INGESTION', True)
+    monkeypatch.setattr(handle_real_time_update, 'delay', lambda rt_update_id: None)
+
+    res, status = api_post('/ire', data=get_ire_data('bad_ire.xml'), check=False)
+    assert status == 202
+
+    handle_real_time_update(res['id'])
+
+    rt_update_status = api_get('/real_time_updates/{}'.format(res['id']))
+    assert rt_update_status['status'] == 'KO'
+    assert rt_update_status['error'] == 'invalid xml, impossible to find "Train" in xml elt InfoRetard'
+
+
+def test_real_time_update_status_not_found():
+    """
+    an unknown or invalid real time update id gives a 404
+    """
+    tester = app.test_client()
+    assert tester.get('/real_time_updates/10866ce8-0638-4fa1-8556-1ddfa22d09d3').status_code == 404
+    assert tester.get('/real_time_updates/bob').status_code == 404
+
+
 def test_ire_delayed_then_OK(mock_rabbitmq):
     """
     We delay a stop, then the vj is back on time
@@ -28,8 +28,10 @@
 # www.navitia.io
 
 from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate, RealTimeUpdate
-from kirin import db, app
+from kirin import db, app, gtfs_realtime_pb2
 import datetime
+import os
+import flask_migrate
 import pytest
 
 
@@ -73,6 +75,99 @@ def test_find_by_vj(setup_database):
         assert row.vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d4'
 
 
+def test_find_by_dated_vjs(setup_database):
+    with app.app_context():
+        assert TripUpdate.find_by_dated_vjs([]) == {}
+
+        res = TripUpdate.find_by_dated_vjs([('vehicle_journey:1', datetime.date(2015, 9, 8)),
+                                            ('vehicle_journey:1', datetime.date(2015, 9, 9)),
+                                            ('vehicle_journey:2', datetime.date(2015, 9, 9))])
+        assert len(res) == 2
+        assert ('vehicle_journey:1', datetime.date(2015, 9, 9)) not in res
+        assert res[('vehicle_journey:1', datetime.date(2015, 9, 8))].vj_id == \
+            '70866ce8-0638-4fa1-8556-1ddfa22d09d3'
+        assert res[('vehicle_journey:2', datetime.date(2015, 9, 9))].vj_id == \
+            '70866ce8-0638-4fa1-8556-1ddfa22d09d5'
+
+
+def test_lock_dated_vjs():
+    """
+    the advisory locks are held until the end of the transaction
+    """
+    def nb_advisory_locks():
+        return db.session.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' "
+                                  "AND pid = pg_backend_pid()").scalar()
+
+    with app.app_context():
+        TripUpdate.lock_dated_vjs([('vehicle_journey:1', datetime.date(2015, 9, 8)),
+                                   ('vehicle_journey:2', datetime.date(2015, 9, 8)),
+                                   ('vehicle_journey:1', datetime.date(2015, 9, 8))])
+        assert nb_advisory_locks() == 2
+        db.session.commit()
+        assert nb_advisory_locks() == 0
+
+
+def test_purge():
+    """
+    the old vjs are purged with their trip updates, stop time updates and real time updates,
+    but a real time update still linked to a recent trip update is kept
+    """
+    with app.app_context():
+        shared_rtu = RealTimeUpdate('', 'ire')
+        shared_rtu.id = '70866ce8-0638-4fa1-8556-1ddfa22d09f1'
+        vjs = [('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vehicle_journey:1', datetime.date(2015, 9, 8)),
+               ('70866ce8-0638-4fa1-8556-1ddfa22d09d4', 'vehicle_journey:2', datetime.date(2015, 9, 8)),
+               ('70866ce8-0638-4fa1-8556-1ddfa22d09d5', 'vehicle_journey:2', datetime.date(2015, 9, 10))]
+        for vj_id, trip_id, date in vjs:
+            trip_update = create_trip_update(vj_id, trip_id, date)
+            trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}))
+            shared_rtu.trip_updates.append(trip_update)
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09f2', 'realtime.ire', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d6', 'vehicle_journey:3', datetime.date(2015, 9, 8))
+        db.session.commit()
+
+        assert VehicleJourney.purge(datetime.date(2015, 9, 9), batch_size=2) == 3
+
+        assert [vj.navitia_trip_id for vj in VehicleJourney.query.all()] == ['vehicle_journey:2']
+        assert len(TripUpdate.query.all()) == 1
+        assert len(StopTimeUpdate.query.all()) == 1
+        assert [rtu.id for rtu in RealTimeUpdate.query.all()] == ['70866ce8-0638-4fa1-8556-1ddfa22d09f1']
+        assert len(RealTimeUpdate.query.first().trip_updates) == 1
+
+
+def test_rt_update_retention():
+    """
+    the retention is applied by connector and status, the KO ones are kept longer
+    """
+    with app.app_context():
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+        for rtu_id, status in [('70866ce8-0638-4fa1-8556-1ddfa22d09f1', 'KO'),
+                               ('70866ce8-0638-4fa1-8556-1ddfa22d09f2', None),
+                               ('70866ce8-0638-4fa1-8556-1ddfa22d09f3', 'OK')]:
+            rtu = RealTimeUpdate('<bob/>', 'ire', status=status)
+            rtu.id = rtu_id
+            rtu.created_at = old
+            db.session.add(rtu)
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09f4', 'realtime.ire', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d6', 'vehicle_journey:3', datetime.date(2015, 9, 8))
+        db.session.commit()
+
+        retention = {'ire': {'KO': 30, '*': 7}}
+        assert RealTimeUpdate.apply_retention(retention, keep_metadata=True, batch_size=1) == 2
+        assert {rtu.id: rtu.raw_data for rtu in RealTimeUpdate.query.all()} == {
+            '70866ce8-0638-4fa1-8556-1ddfa22d09f1': '<bob/>',
+            '70866ce8-0638-4fa1-8556-1ddfa22d09f2': None,
+            '70866ce8-0638-4fa1-8556-1ddfa22d09f3': None,
+            '70866ce8-0638-4fa1-8556-1ddfa22d09f4': '',
+        }
+
+        assert RealTimeUpdate.apply_retention(retention, batch_size=1) == 2
+        assert {rtu.id for rtu in RealTimeUpdate.query.all()} == {'70866ce8-0638-4fa1-8556-1ddfa22d09f1',
+                                                                  '70866ce8-0638-4fa1-8556-1ddfa22d09f4'}
+        # the trip updates are kept
+        assert len(TripUpdate.query.all()) == 1
+
+
 def test_find_stop():
     with app.app_context():
         vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
@@ -88,6 +183,30 @@ def test_find_stop():
         assert vj.find_stop('sa:4') is None
 
 
+def test_find_stop_multiple_times():
+    with app.app_context():
+        vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        st1 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        vj.stop_time_updates.append(st1)
+        st2 = StopTimeUpdate({'id': 'sa:2'}, None, None)
+        vj.stop_time_updates.append(st2)
+        st3 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        vj.stop_time_updates.append(st3)
+
+        assert vj.find_stop('sa:1') == st1
+        assert vj.find_stop('sa:1', 1) == st3
+        assert vj.find_stop('sa:1', 2) is None
+        assert vj.find_stop('sa:2', 1) is None
+
+        # the index is kept up to date when the stop_time_updates are modified
+        vj.stop_time_updates.remove(st1)
+        assert vj.find_stop('sa:1') == st3
+        st4 = StopTimeUpdate({'id': 'sa:4'}, None, None)
+        vj.stop_time_updates = [st4]
+        assert vj.find_stop('sa:1') is None
+        assert vj.find_stop('sa:4') == st4
+
+
 def test_find_activate():
     with app.app_context():
         create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'C1', 'ire',
@@ -350,6 +469,97 @@ def test_find_activate():
         assert len(rtu) == 2
 
 
+def test_find_by_contributor_period_by_chunks():
+    with app.app_context():
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'C1', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d4', 'C1', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d4', 'vj2', datetime.date(2015, 9, 10))
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d5', 'C1', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d5', 'vj3', datetime.date(2015, 9, 12))
+        create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d6', 'C2', 'ire',
+                                '70866ce8-0638-4fa1-8556-1ddfa22d09d6', 'vj4', datetime.date(2015, 9, 12))
+        db.session.commit()
+
+        assert TripUpdate.count_by_contributor_period(['C1']) == 3
+        chunks = list(TripUpdate.find_by_contributor_period_by_chunks(['C1'], chunk_size=2))
+        assert [[tu.vj_id for tu in chunk] for chunk in chunks] == [
+            ['70866ce8-0638-4fa1-8556-1ddfa22d09d3', '70866ce8-0638-4fa1-8556-1ddfa22d09d4'],
+            ['70866ce8-0638-4fa1-8556-1ddfa22d09d5'],
+        ]
+
+        assert TripUpdate.count_by_contributor_period(['C1', 'C2'], datetime.date(2015, 9, 9),
+                                                      datetime.date(2015, 9, 11)) == 1
+        chunks = list(TripUpdate.find_by_contributor_period_by_chunks(['C1', 'C2'], datetime.date(2015, 9, 9),
+                                                                      datetime.date(2015, 9, 11)))
+        assert len(chunks) == 1
+        assert chunks[0][0].vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d4'
+
+        assert list(TripUpdate.find_by_contributor_period_by_chunks(['C3'])) == []
+
+
+def test_raw_data(monkeypatch):
+    with app.app_context():
+        monkeypatch.setitem(app.config, 'RAW_DATA_CODEC', 'gzip')
+        rtu = RealTimeUpdate('<xml>bob</xml>', 'ire')
+        rtu.id = '70866ce8-0638-4fa1-8556-1ddfa22d09d3'
+        db.session.add(rtu)
+        db.session.add(RealTimeUpdate(None, 'ire'))
+        # an old RealTimeUpdate with the raw data in the text column
+        db.session.execute("INSERT INTO real_time_update (id, received_at, created_at, connector, raw_data) "
+                           "VALUES ('70866ce8-0638-4fa1-8556-1ddfa22d09d4', now(), now(), 'ire', 'old bob')")
+        db.session.commit()
+
+        rtu = RealTimeUpdate.query.get('70866ce8-0638-4fa1-8556-1ddfa22d09d3')
+        assert rtu.raw_data == '<xml>bob</xml>'
+        assert rtu.raw_data_codec == 'gzip'
+        assert RealTimeUpdate.query.get('70866ce8-0638-4fa1-8556-1ddfa22d09d4').raw_data == 'old bob'
+        assert len(RealTimeUpdate.find_with_text_raw_data(10)) == 1
+
+        old_rtu = RealTimeUpdate.find_with_text_raw_data(10)[0]
+        old_rtu.raw_data = old_rtu.raw_data
+        db.session.commit()
+        assert RealTimeUpdate.find_with_text_raw_data(10) == []
+        assert RealTimeUpdate.query.get('70866ce8-0638-4fa1-8556-1ddfa22d09d4').raw_data == 'old bob'
+
+
+def test_raw_data_downgrade(monkeypatch):
+    """
+    the downgrade of the binary raw data moves them back in the text column, in their previous form
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = 0
+    entity = feed.entity.add()
+    entity.id = 'bob'
+    entity.trip_update.trip.trip_id = 'vj:1'
+    entity.trip_update.stop_time_update.add().arrival.delay = 0
+    assert '\x00' in feed.SerializeToString()
+
+    migration_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'migrations')
+    with app.app_context():
+        rt_updates = {}
+        for codec in ('raw', 'gzip'):
+            monkeypatch.setitem(app.config, 'RAW_DATA_CODEC', codec)
+            for connector, data in (('ire', '<xml>bob</xml>'), ('gtfs-rt', feed.SerializeToString())):
+                rtu = RealTimeUpdate(data, connector)
+                db.session.add(rtu)
+                rt_updates[rtu.id] = (connector, codec)
+        db.session.commit()
+        db.session.remove()
+
+        flask_migrate.downgrade(revision='3d8a1f2b7c40', directory=migration_dir)
+        try:
+            raw_data = dict(db.session.execute('SELECT id, raw_data FROM real_time_update').fetchall())
+            db.session.remove()
+        finally:
+            flask_migrate.upgrade(directory=migration_dir)
+
+    assert len(raw_data) == 4
+    for rtu_id, (connector, _) in rt_updates.items():
+        assert raw_data[rtu_id] == ('<xml>bob</xml>' if connector == 'ire' else str(feed))
+
+
 def test_update_stoptime():
     with app.app_context():
         st = StopTimeUpdate({'id': 'foo'},
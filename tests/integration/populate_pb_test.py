@@ -29,7 +29,7 @@
 from datetime import timedelta
 
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time
+from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time, serialize_gtfsrt
 import datetime
 from kirin import app, db
 from kirin import gtfs_realtime_pb2, kirin_pb2, chaos_pb2
@@ -328,3 +328,39 @@ def test_populate_pb_with_full_dataset():
         assert pb_trip_update.trip.Extensions[kirin_pb2.contributor] == 'kisio-digital'
 
         assert len(feed_entity.entity[0].trip_update.stop_time_update) == 0
+
+
+def test_serialize_gtfsrt():
+    """
+    the serialized feed is the same as the one built by convert_to_gtfsrt, even with an entity from the cache
+    """
+    navitia_vj = {'trip': {'id': 'vehicle_journey:1'}, 'stop_times': [
+        {'arrival_time': None, 'departure_time': datetime.time(8, 10), 'stop_point': {'id': 'sa:1'}},
+        {'arrival_time': datetime.time(9, 10), 'departure_time': None, 'stop_point': {'id': 'sa:2'}}
+        ]}
+
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.contributor = 'realtime.ire'
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:15"), arrival=None,
+                                                            message="bob's on the track"))
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire')
+        real_time_update.trip_updates.append(trip_update)
+        trip_update.fingerprint = trip_update.compute_fingerprint()
+        db.session.add(real_time_update)
+        db.session.commit()
+
+        for _ in range(2):
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.ParseFromString(serialize_gtfsrt(real_time_update.trip_updates))
+            expected = convert_to_gtfsrt(real_time_update.trip_updates)
+            expected.header.timestamp = feed.header.timestamp
+            assert feed == expected
+
+        # the cached entity is not used anymore once the trip update has changed
+        trip_update.status = 'delete'
+        trip_update.fingerprint = trip_update.compute_fingerprint()
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(serialize_gtfsrt(real_time_update.trip_updates))
+        assert feed.entity[0].trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED
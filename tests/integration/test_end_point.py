@@ -46,6 +46,9 @@ def test_status(setup_database):
     assert 'db_pool_status' in resp
     assert 'db_version' in resp
     assert 'navitia_url' in resp
+    assert 'navitia_cache' in resp
+    assert 'feed_coalescer' in resp
+    assert 'priority_publisher' in resp
     assert 'last_update' in resp
     assert 'realtime.ire' in resp['last_update']
     assert 'realtime.timeo' in resp['last_update']
@@ -1,5 +1,7 @@
-from kirin.utils import str_to_date
+from kirin.utils import str_to_date, log_payload, TruncatedPayload
+from kirin import app, gtfs_realtime_pb2
 import datetime
+import logging
 
 
 def test_valid_date():
@@ -10,3 +12,48 @@ def test_valid_date():
 def test_invalid_date():
     res = str_to_date('aaaa')
     assert res == None
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_log_payload(monkeypatch):
+    """
+    the payloads are truncated, and only logged for the sampled contributors
+    """
+    monkeypatch.setitem(app.config, 'PAYLOAD_LOG_MAX_SIZE', 5)
+    monkeypatch.setitem(app.config, 'PAYLOAD_LOG_SAMPLING', {'muted': 0.})
+    handler = ListHandler()
+    logger = logging.getLogger('kirin.payload')
+    logger.addHandler(handler)
+    previous_level = logger.level
+    logger.setLevel(logging.DEBUG)
+    try:
+        with app.app_context():
+            log_payload('feed', 'toto_titi', 'bob')
+            log_payload('feed', 'toto_titi', 'muted')
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(previous_level)
+
+    assert handler.messages == ['feed: toto_... (truncated)']
+
+
+def test_truncated_protobuf_payload():
+    """
+    a protobuf payload is formatted only up to the max size
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    for i in range(1000):
+        feed.entity.add().id = 'entity:{}'.format(i)
+
+    assert str(TruncatedPayload(feed, 1000000)) == str(feed)
+    res = str(TruncatedPayload(feed, 50))
+    assert res == str(feed)[:50] + '... (truncated)'
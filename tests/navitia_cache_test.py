@@ -0,0 +1,92 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from kirin.navitia_cache import LocalCache, NavitiaCache, make_navitia_cache
+
+
+class DumbNavitia(object):
+    url = 'http://bob/'
+
+    def __init__(self, response):
+        self.response = response
+        self.nb_calls = 0
+
+    def vehicle_journeys(self, q=None):
+        self.nb_calls += 1
+        return self.response
+
+
+def test_local_cache_lru():
+    cache = LocalCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # 'a' is now the most recently used
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_local_cache_ttl():
+    cache = LocalCache(max_size=2, ttl=60)
+    cache.set('a', 1, ttl=-1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_navitia_cache_hit_and_miss():
+    nav = DumbNavitia([{'id': 'vj:1'}])
+    cache = NavitiaCache(LocalCache())
+
+    assert cache.vehicle_journeys(nav, q={'headsign': '42', 'depth': '2'}) == [{'id': 'vj:1'}]
+    assert cache.vehicle_journeys(nav, q={'depth': '2', 'headsign': '42'}) == [{'id': 'vj:1'}]
+    assert nav.nb_calls == 1
+    assert cache.info()['hits'] == 1
+    assert cache.info()['misses'] == 1
+
+
+def test_navitia_cache_empty_response_not_cached():
+    nav = DumbNavitia([])
+    cache = NavitiaCache(LocalCache())
+
+    assert cache.vehicle_journeys(nav, q={'headsign': '42'}) == []
+    assert cache.vehicle_journeys(nav, q={'headsign': '42'}) == []
+    assert nav.nb_calls == 2
+
+
+def test_no_navitia_cache():
+    nav = DumbNavitia([{'id': 'vj:1'}])
+    cache = make_navitia_cache({'NAVITIA_CACHE_BACKEND': None})
+
+    cache.vehicle_journeys(nav, q={'headsign': '42'})
+    cache.vehicle_journeys(nav, q={'headsign': '42'})
+    assert nav.nb_calls == 2
+    assert cache.info() == {'backend': None}
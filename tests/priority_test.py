@@ -0,0 +1,107 @@
+# Copyright (c) 2001-2017, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+from datetime import timedelta
+from kirin.core.model import TripUpdate, StopTimeUpdate
+from kirin.core.priority import PriorityPublisher, publication_class
+from kirin.exceptions import MessageNotPublished
+import pytest
+
+
+def test_publication_class():
+    threshold = timedelta(minutes=10)
+    assert publication_class(TripUpdate(status='delete'), threshold) == 'cancellation'
+
+    trip_update = TripUpdate(status='update')
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=2)))
+    assert publication_class(trip_update, threshold) == 'other'
+
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=15)))
+    assert publication_class(trip_update, threshold) == 'large_delay'
+
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:3'}, dep_status='delete'))
+    assert publication_class(trip_update, threshold) == 'partial_deletion'
+
+
+def test_priority_lanes():
+    """
+    the most urgent lane is published first, and only the latest state of a trip is published
+
+    the lanes are published by hand (the greenlet is only started by add)
+    """
+    published = []
+    publisher = PriorityPublisher(publish=lambda feed, contributor: published.append(contributor))
+
+    publisher.add_entity('other', 'bob', 'vj:1', 'a')
+    publisher.add_entity('other', 'bobette', 'vj:2', 'b')
+    publisher.add_entity('large_delay', 'bob', 'vj:3', 'c')
+    publisher.add_entity('cancellation', 'bob', 'vj:1', 'd')
+
+    assert publisher.info()['other']['queued'] == 1
+    assert publisher.publish_next() == 'cancellation'
+    assert publisher.publish_next() == 'large_delay'
+    assert publisher.publish_next() == 'other'
+    assert publisher.publish_next() is None
+    assert published == ['bob', 'bob', 'bobette']
+
+    info = publisher.info()
+    assert info['cancellation']['published'] == 1
+    assert info['other']['published'] == 1
+    assert info['other']['max_latency'] >= 0
+
+
+def test_priority_lane_full():
+    publisher = PriorityPublisher(lane_size=1, timeout=0, publish=lambda feed, contributor: None)
+
+    publisher.add_entity('other', 'bob', 'vj:1', 'a')
+    with pytest.raises(MessageNotPublished):
+        publisher.add_entity('other', 'bob', 'vj:2', 'b')
+    # the other lanes are not blocked
+    publisher.add_entity('cancellation', 'bob', 'vj:2', 'b')
+
+
+def test_priority_lane_full_keeps_waiting_state():
+    publisher = PriorityPublisher(lane_size=1, timeout=0, publish=lambda feed, contributor: None)
+
+    publisher.add_entity('other', 'bob', 'vj:1', 'a')
+    publisher.add_entity('cancellation', 'bob', 'vj:2', 'b')
+    with pytest.raises(MessageNotPublished):
+        publisher.add_entity('cancellation', 'bob', 'vj:1', 'c')
+    # the trip is still waiting with its previous state
+    assert publisher.info()['other']['queued'] == 1
+
+    # a trip already in a full lane is replaced without waiting
+    publisher.add_entity('cancellation', 'bob', 'vj:2', 'd')
+    assert publisher.info()['cancellation']['queued'] == 1
+
+    # publishing frees some room
+    assert publisher.publish_next() == 'cancellation'
+    publisher.add_entity('cancellation', 'bob', 'vj:1', 'c')
+    assert publisher.info()['other']['queued'] == 0
+    assert publisher.info()['cancellation']['queued'] == 1
@@ -18,6 +18,8 @@ NAVITIA_URL = 'http://navitia2-ws.ctp.dev.canaltp.fr/'
 NAVITIA_TOKEN = '0e3517e5-fd38-47f9-83f5-63837b34c9bf'
 
 NAVITIA_INSTANCE = 'sncfnational'
+#the navitia responses must not be shared between the tests
+NAVITIA_CACHE_BACKEND = None
 #Log Level available
 # - DEBUG
 # - INFO